@@ -0,0 +1,50 @@
+# Generated by Django 5.1.3 on 2026-10-17 13:10
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+import json
+
+DEFAULT_SETTINGS = {
+    "city": "Beograd",
+    "price": "50000-150000",
+    "size": "45-120",
+    "rooms": "3.0",
+    "is_enabled": True,
+}
+
+
+def reset_invalid_settings(apps, schema_editor):
+    # the generated column casts every row, one invalid json fails the migration
+    User = apps.get_model("bot", "User")
+    invalid_ids = []
+    for user_id, settings in User.objects.values_list("id", "settings").iterator():
+        try:
+            is_valid = isinstance(json.loads(settings), dict)
+        except (TypeError, ValueError):
+            is_valid = False
+        if not is_valid:
+            invalid_ids.append(user_id)
+    User.objects.filter(id__in=invalid_ids).update(
+        settings=json.dumps(DEFAULT_SETTINGS)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("bot", "0004_alter_user_name_alter_user_profile_url_and_more"),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_invalid_settings, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name="user",
+            name="settings_json",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.db.models.functions.comparison.Cast(
+                    "settings", models.JSONField()
+                ),
+                output_field=models.JSONField(),
+            ),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Cast
 from common.models import TimestampedMixin
 import json
 
@@ -18,6 +19,12 @@ class User(TimestampedMixin, models.Model):
     name = models.CharField(max_length=255, null=True, blank=True)
     profile_url = models.CharField(max_length=255, null=True, blank=True)
     settings = models.TextField(default=json.dumps(DEFAULT_SETTINGS))
+    # settings as jsonb, kept by postgres so queue matching can run in sql
+    settings_json = models.GeneratedField(
+        expression=Cast("settings", models.JSONField()),
+        output_field=models.JSONField(),
+        db_persist=True,
+    )
 
     def __str__(self):
         return f"{self.username} - {self.name}"
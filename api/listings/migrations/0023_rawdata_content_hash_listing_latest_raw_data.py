@@ -0,0 +1,41 @@
+# Generated by Django 5.1.3 on 2026-10-17 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0022_remove_listing_total_views_remove_listing_valid_from_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rawdata",
+            name="content_hash",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="listing",
+            name="latest_raw_data",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="listings.rawdata",
+            ),
+        ),
+        # point every listing to its most recent raw data
+        migrations.RunSQL(
+            sql="""
+            UPDATE listings_listing AS ll SET latest_raw_data_id = rd.id
+            FROM (
+                SELECT DISTINCT ON (listing_id) id, listing_id
+                FROM listings_rawdata
+                ORDER BY listing_id, created_at DESC
+            ) AS rd
+            WHERE rd.listing_id = ll.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.3 on 2026-10-17 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0023_rawdata_content_hash_listing_latest_raw_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rawdata",
+            name="html_key",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="rawdata",
+            name="data_key",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name="RawPayload",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "key",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                ("size", models.IntegerField()),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.CreateModel(
+            name="RawPayloadDictionary",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("source_name", models.CharField(db_index=True, max_length=255)),
+                ("data", models.BinaryField()),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
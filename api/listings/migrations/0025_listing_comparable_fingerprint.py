@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-17 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0024_rawdata_html_key_rawdata_data_key_rawpayload_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="listing",
+            name="comparable_fingerprint",
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-17 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0025_listing_comparable_fingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueueWatermark",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "source_name",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("last_created_at", models.DateTimeField()),
+                ("last_listing_id", models.UUIDField()),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0026_queuewatermark"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="report",
+            name="total_queued_listings",
+            field=models.IntegerField(default=0),
+        ),
+    ]
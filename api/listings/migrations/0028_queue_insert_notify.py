@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-17 15:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("listings", "0027_report_total_queued_listings"),
+    ]
+
+    operations = [
+        # wake up the listening senders once per insert statement
+        migrations.RunSQL(
+            sql="""
+            CREATE OR REPLACE FUNCTION listings_queue_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('listings_queue', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER listings_queue_notify
+            AFTER INSERT ON listings_queue
+            FOR EACH STATEMENT EXECUTE FUNCTION listings_queue_notify();
+            """,
+            reverse_sql="""
+            DROP TRIGGER IF EXISTS listings_queue_notify ON listings_queue;
+            DROP FUNCTION IF EXISTS listings_queue_notify();
+            """,
+        ),
+    ]
@@ -28,6 +28,11 @@ class Listing(TimestampedMixin, models.Model):
     longitude = models.FloatField(null=True)
     source = models.ForeignKey(Source, on_delete=models.SET_NULL, null=True)
     seller = models.ForeignKey("Seller", on_delete=models.SET_NULL, null=True)
+    latest_raw_data = models.ForeignKey(
+        "RawData", on_delete=models.SET_NULL, null=True, related_name="+"
+    )
+    # sha256 of the fields compared by the crawler to detect listing changes
+    comparable_fingerprint = models.CharField(max_length=64, null=True)
 
     def __str__(self):
         return f"{self.source.name} - {self.url}"
@@ -38,6 +43,22 @@ class RawData(TimestampedMixin, models.Model):
     listing = models.ForeignKey(Listing, on_delete=models.CASCADE, null=True)
     html = models.TextField()
     data = models.TextField()
+    content_hash = models.CharField(max_length=64, null=True)
+    # payloads kept in the raw payload store, html and data stay empty
+    html_key = models.CharField(max_length=64, null=True)
+    data_key = models.CharField(max_length=64, null=True)
+
+
+class RawPayload(TimestampedMixin, models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.IntegerField()
+
+
+class RawPayloadDictionary(TimestampedMixin, models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    source_name = models.CharField(max_length=255, db_index=True)
+    data = models.BinaryField()
 
 
 class Property(TimestampedMixin, models.Model):
@@ -131,6 +152,7 @@ class Report(TimestampedMixin, models.Model):
     total_actual_listings = models.IntegerField(default=0)
     total_new_listings = models.IntegerField(default=0)
     total_changed_listings = models.IntegerField(default=0)
+    total_queued_listings = models.IntegerField(default=0)
     item_scraped_count = models.IntegerField()
     item_dropped_count = models.IntegerField()
     response_error_count = models.IntegerField()
@@ -168,3 +190,10 @@ class Queue(TimestampedMixin, models.Model):
 
     def __str__(self):
         return " to ".join([self.listing.id, self.user.chat_id])
+
+
+class QueueWatermark(TimestampedMixin, models.Model):
+    # newest listing of the source already matched to the users settings
+    source_name = models.CharField(max_length=255, primary_key=True)
+    last_created_at = models.DateTimeField()
+    last_listing_id = models.UUIDField()
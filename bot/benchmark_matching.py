@@ -0,0 +1,87 @@
+"""
+Benchmark of the listings x users matching.
+
+    python benchmark_matching.py --users 10000 --listings 5000
+
+Synthetic users and listings, no database needed. validate_settings is timed
+on a sample of listings and extrapolated, the matchers are checked against it
+on that sample.
+"""
+
+from argparse import ArgumentParser
+import json
+import random
+import time
+
+from batch_matching import BatchMatcher
+from constants import ROOM_OPTIONS
+from matching import MatchingEngine
+from models import CustomListing
+
+CITIES = ["Beograd", "Novi Sad", "Niš", "Kragujevac", "Subotica"]
+
+
+def random_settings():
+    price_min = random.randrange(0, 300000, 10000)
+    size_min = random.randrange(20, 100, 5)
+    return json.dumps(
+        dict(
+            city=",".join(random.sample(CITIES, random.randint(1, 2))),
+            price=f"{price_min}-{price_min + random.randrange(10000, 200000, 10000)}",
+            size=f"{size_min}-{size_min + random.randrange(10, 100, 5)}",
+            rooms=",".join(random.sample(ROOM_OPTIONS, random.randint(1, 3))),
+            is_enabled=random.random() > 0.05,
+        )
+    )
+
+
+def random_listing(i):
+    return CustomListing(
+        id=i,
+        city=random.choice(CITIES),
+        price=random.randrange(30000, 500000, 1000),
+        size_m2=random.randrange(15, 200),
+        rooms=float(random.choice(ROOM_OPTIONS)),
+    )
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<28} {time.perf_counter() - start:>8.3f}s")
+    return result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--listings", type=int, default=5000)
+    parser.add_argument("--sample", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    users = [(i, random_settings()) for i in range(args.users)]
+    listings = [random_listing(i) for i in range(args.listings)]
+    sample = listings[: args.sample]
+    print(f"{args.users} users x {args.listings} listings")
+
+    start = time.perf_counter()
+    expected = {
+        (l.id, user_id)
+        for l in sample
+        for user_id, settings in users
+        if l.validate_settings(settings)
+    }
+    elapsed = (time.perf_counter() - start) * len(listings) / len(sample)
+    print(f"{'validate_settings (estimate)':<28} {elapsed:>8.3f}s")
+    for name, matcher in [("index", MatchingEngine()), ("numpy", BatchMatcher())]:
+        timed(f"{name} build", lambda: matcher.sync(users))
+        sample_pairs = {(l.id, user_id) for l, user_id in matcher.pairs(sample)}
+        assert sample_pairs == expected, f"{name} differs from validate_settings"
+        pairs = timed(f"{name} match", lambda: sum(1 for _ in matcher.pairs(listings)))
+        print(f"{name} pairs: {pairs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,25 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from decouple import config
 
 engine = create_engine(config("DB_URL"))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the handlers of main.py share one bounded pool of asyncpg connections, a
+# slow query only holds its own connection instead of the event loop
+async_engine = create_async_engine(
+    make_url(config("DB_URL")).set(drivername="postgresql+asyncpg"),
+    pool_size=config("DB_POOL_SIZE", default=5, cast=int),
+    max_overflow=config("DB_POOL_MAX_OVERFLOW", default=5, cast=int),
+    pool_timeout=config("DB_POOL_TIMEOUT", default=30, cast=int),
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
 
 def get_db():
     db = SessionLocal()
@@ -3,6 +3,7 @@ import re
 
 def settings_as_message(settings: dict) -> str:
     is_enabled = "✅ *Enabled*" if settings.get("is_enabled", True) else "❌ *Disabled*"
+    digest = "📰 *Digest:* On" if settings.get("digest", False) else "📰 *Digest:* Off"
     price = settings.get("price").split("-")
     settings_price = f"€{int(price[0]):,d}-{int(price[1]):,d}"
     rooms = ",".join(settings.get("rooms"))
@@ -14,6 +15,7 @@ def settings_as_message(settings: dict) -> str:
         f"📐 *Size:* {settings['size']} m2\n"
         f"🏠 *Rooms:* {rooms}\n"
         f"{is_enabled}\n"
+        f"{digest}\n"
     )
     message = re.sub(r"([\-.])", r"\\\1", message)
     return message
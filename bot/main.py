@@ -12,9 +12,11 @@ from telegram.ext import (
 )
 from datetime import datetime
 from decouple import config
-from database import get_db
-from sqlalchemy import text
+from database import AsyncSessionLocal, async_engine
+from sqlalchemy import select, text
 from models import User, CustomListing
+from matching import invalidate_settings_predicate
+from settings_cache import get_settings, set_settings
 from constants import DEFAULT_SETTINGS, CITY_OPTIONS, ROOM_OPTIONS
 from func import (
     settings_as_message,
@@ -54,10 +56,10 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # insert user to database, on conflict update
     username = update.message.chat.username
     user_item = dict(
-        id=str(uuid.uuid4()),
+        id=uuid.uuid4(),
         created_at=datetime.now(),
         updated_at=datetime.now(),
-        chat_id=update.message.chat.id,
+        chat_id=str(update.message.chat.id),
         username=username,
         name=update.message.chat.full_name,
         profile_url=f"https://t.me/{username}",
@@ -78,13 +80,13 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ON CONFLICT (username) DO UPDATE SET name = :name, profile_url = :profile_url, updated_at = :updated_at;
         """
     )
-    db = next(get_db())
-    try:
-        db.execute(q, user_item)
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error assigning user to database: {e}")
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.execute(q, user_item)
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Error assigning user to database: {e}")
     # send hi to user
     message = (
         f"Hi! 👋🏼 @{username}\n\n"
@@ -95,20 +97,9 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Query user
-    db = next(get_db())
+    # load user settings as dictionary, rooms and city as lists
     chat_id = str(update.message.chat.id)
-    user = db.query(User).filter(User.chat_id == chat_id).first()
-    # load user settings as dictionary
-    user_settings = json.loads(user.settings)
-    # convert rooms to list
-    settings_rooms = user_settings["rooms"]
-    if isinstance(settings_rooms, str):
-        user_settings["rooms"] = settings_rooms.split(",")
-    # convert city to list
-    settings_cities = user_settings["city"]
-    if isinstance(settings_cities, str):
-        user_settings["city"] = settings_cities.split(",")
+    user_settings = await get_settings(chat_id)
     await update.message.reply_text(
         settings_as_message(user_settings),
         reply_markup=configure_markup,
@@ -126,14 +117,8 @@ async def configure_settings_command(
         if "temp_city" not in context.user_data:
             context.user_data["temp_city"] = list(settings["city"])
     else:
-        db = next(get_db())
         chat_id = str(update.callback_query.message.chat.id)
-        user = db.query(User).filter(User.chat_id == chat_id).first()
-        settings = json.loads(user.settings)
-        if isinstance(settings["rooms"], str):
-            settings["rooms"] = settings["rooms"].split(",")
-        if isinstance(settings["city"], str):
-            settings["city"] = settings["city"].split(",")
+        settings = await get_settings(chat_id)
         context.user_data["settings"] = settings
         context.user_data["temp_rooms"] = list(settings["rooms"])
         context.user_data["temp_city"] = list(settings["city"])
@@ -222,6 +207,12 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(**message)
         return ConversationHandler.END
+    elif query.data == "digest":
+        # one message bundling several listings instead of one per listing
+        settings = context.user_data["settings"]
+        settings["digest"] = not settings.get("digest", False)
+        await configure_settings_command(update, context)
+        return ConversationHandler.END
     elif query.data == "save":
         await save_settings(update, context)
         await query.edit_message_text(text="Settings have been saved!")
@@ -329,9 +320,7 @@ async def update_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def save_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "settings" in context.user_data:
-        db = next(get_db())
         chat_id = str(update.callback_query.message.chat.id)
-        user = db.query(User).filter(User.chat_id == chat_id).first()
         settings = context.user_data.get("settings")
         # stringify settings rooms
         if isinstance(settings["rooms"], list):
@@ -342,11 +331,6 @@ async def save_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
             settings["city"] = ",".join(cities)
         new_settings = json.dumps(settings)
         is_enabled = settings.get("is_enabled", True)
-        if user.settings != new_settings and is_enabled:
-            user.settings = new_settings
-            db.commit()
-            db.refresh(user)
-        # send listings after user save the settings
         cols = [
             "id",
             "url",
@@ -357,25 +341,37 @@ async def save_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "size_m2",
             "rooms",
         ]
-        q = text(
-            f"""
-            SELECT
-                listings.id,
-                listings.url,
-                listings.city as city,
-                listings.price as price,
-                listings.municipality,
-                listings.micro_location,
-                COALESCE(MAX(properties.size_m2), 0) AS size_m2,
-                COALESCE(MAX(properties.rooms), 0) AS rooms
-            FROM listings_listing as listings
-            JOIN listings_property as properties ON listings.id = properties.listing_id
-            WHERE {user.settings_as_where_clause()}
-            GROUP BY listings.id LIMIT 10;
-            """
-        )
-        result = db.execute(q)
-        listings = result.fetchall()
+        # the connection goes back to the pool before the replies are sent
+        async with AsyncSessionLocal() as db:
+            user = await db.scalar(select(User).where(User.chat_id == chat_id))
+            if user.settings != new_settings and is_enabled:
+                user.settings = new_settings
+                await db.commit()
+                invalidate_settings_predicate(user.id)
+            # send listings after user save the settings
+            where_clause, params = user.settings_as_where_clause()
+            q = text(
+                f"""
+                SELECT
+                    listings.id,
+                    listings.url,
+                    listings.city as city,
+                    listings.price as price,
+                    listings.municipality,
+                    listings.micro_location,
+                    COALESCE(MAX(properties.size_m2), 0) AS size_m2,
+                    COALESCE(MAX(properties.rooms), 0) AS rooms
+                FROM listings_listing as listings
+                JOIN listings_property as properties
+                    ON listings.id = properties.listing_id
+                WHERE {where_clause}
+                GROUP BY listings.id LIMIT 10;
+                """
+            )
+            result = await db.execute(q, params)
+            listings = result.fetchall()
+        # write through, the cache holds the settings as stored
+        set_settings(chat_id, user.settings)
         # convert raw data into custom listings
         listings = [dict(zip(cols, listing)) for listing in listings]
         listings = [CustomListing(**item) for item in listings]
@@ -387,22 +383,20 @@ async def save_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "settings" in context.user_data:
-        db = next(get_db())
         chat_id = str(update.callback_query.message.chat.id)
-        user = db.query(User).filter(User.chat_id == chat_id).first()
-        context.user_data["settings"] = json.loads(user.settings)
-        # split the rooms
-        settings_rooms = context.user_data["settings"]["rooms"]
-        settings_rooms = settings_rooms.split(",")
-        context.user_data["settings"]["rooms"] = settings_rooms
+        context.user_data["settings"] = await get_settings(chat_id)
         # reset the rooms
-        context.user_data["temp_rooms"] = context.user_data["settings"]["rooms"]
+        context.user_data["temp_rooms"] = list(context.user_data["settings"]["rooms"])
         # reset the city
-        context.user_data["temp_city"] = context.user_data["settings"]["city"]
+        context.user_data["temp_city"] = list(context.user_data["settings"]["city"])
     return ConversationHandler.END
 
 
 # Handlers
+async def close_database(app: Application):
+    await async_engine.dispose()
+
+
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Error: {context.error}")
     try:
@@ -413,7 +407,7 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 if __name__ == "__main__":
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).post_shutdown(close_database).build()
 
     # Commands
     app.add_handler(CommandHandler("start", start_command))
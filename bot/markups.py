@@ -4,6 +4,7 @@ from constants import ROOM_OPTIONS, CITY_OPTIONS
 
 def create_settings_markup(settings: dict) -> InlineKeyboardMarkup:
     is_enabled = "✅ Enabled" if settings.get("is_enabled", True) else "❌ Disabled"
+    digest = "📰 Digest: On" if settings.get("digest", False) else "📰 Digest: Off"
     price = settings.get("price").split("-")
     settings_price = f"€{int(price[0]):,d}-{int(price[1]):,d}"
     rooms_value = settings.get("rooms")
@@ -43,6 +44,12 @@ def create_settings_markup(settings: dict) -> InlineKeyboardMarkup:
                     callback_data="is_enabled",
                 )
             ],
+            [
+                InlineKeyboardButton(
+                    digest,
+                    callback_data="digest",
+                )
+            ],
             [
                 InlineKeyboardButton("❌ Cancel", callback_data="cancel"),
                 InlineKeyboardButton("💾 Save", callback_data="save"),
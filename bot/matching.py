@@ -0,0 +1,262 @@
+"""
+Match new listings to the users whose settings accept them.
+
+The settings of every user are compiled once into indexes, users being bits
+of a python int bitmap:
+- city token -> users, a token matches when it is contained in the city
+- room value -> users
+- price and size bounds sorted, with prefix bitmaps over the sorted order so
+  that "min < value" and "value < max" are one bisect and a few ORs
+
+Matching gives the same result as CustomListing.validate_settings.
+"""
+
+from bisect import bisect_left, bisect_right
+import hashlib
+import json
+
+CHECKPOINT = 64  # one prefix bitmap every 64 sorted bounds
+
+
+def parse_settings(settings):
+    """Parse the settings json as validate_settings does, None if invalid."""
+    try:
+        settings = json.loads(settings)
+        if not settings.get("is_enabled", True):
+            return None
+        price_min, price_max = settings["price"].split("-")
+        size_min, size_max = settings["size"].split("-")
+        return dict(
+            cities=settings["city"].split(","),
+            rooms={float(room) for room in settings["rooms"].split(",")},
+            price=(float(price_min), float(price_max)),
+            size=(float(size_min), float(size_max)) if size_min and size_max else None,
+        )
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+class SettingsPredicate:
+    """
+    Settings of one user compiled once, matched in memory with matches() or
+    in sql with as_where_clause().
+    """
+
+    def __init__(self, settings):
+        parsed = parse_settings(settings)
+        self.is_valid = parsed is not None
+        parsed = parsed or dict(cities=[], rooms=set(), price=None, size=None)
+        self.cities = parsed["cities"]
+        self.rooms = parsed["rooms"]
+        self.price = parsed["price"]
+        self.size = parsed["size"]
+
+    def matches(self, listing):
+        if not self.is_valid:
+            return False
+        # is listing.city is contain settings.city?
+        if listing.city and not any(city in listing.city for city in self.cities):
+            return False
+        # is listing.rooms is equal to settings.rooms?
+        if listing.rooms and float(listing.rooms) not in self.rooms:
+            return False
+        # is listing.price is between price min and price max?
+        price_min, price_max = self.price
+        if listing.price and not (price_min < float(listing.price) < price_max):
+            return False
+        # is listing.size is between size min and size max?
+        if listing.size_m2 and self.size:
+            size_min, size_max = self.size
+            if not (size_min < float(listing.size_m2) < size_max):
+                return False
+        return True
+
+    def as_where_clause(self, listing_alias="ll", property_alias="lp"):
+        """
+        Parameterized sql clause, same rules as matches(): a missing (NULL or
+        0) price, size or room count skips its check, as in validate_settings.
+        """
+        if not self.is_valid:
+            return "FALSE", {}
+        rules = [
+            f"""(coalesce({listing_alias}.city, '') = '' OR EXISTS (
+                SELECT 1 FROM unnest(CAST(:cities AS text[])) AS c (city)
+                WHERE strpos({listing_alias}.city, c.city) > 0
+            ))""",
+            f"(coalesce({property_alias}.rooms, 0) = 0"
+            f" OR {property_alias}.rooms = ANY(CAST(:rooms AS float8[])))",
+            f"(coalesce({listing_alias}.price, 0) = 0"
+            f" OR ({listing_alias}.price > :price_min"
+            f" AND {listing_alias}.price < :price_max))",
+        ]
+        params = dict(
+            cities=self.cities,
+            rooms=sorted(self.rooms),
+            price_min=self.price[0],
+            price_max=self.price[1],
+        )
+        if self.size:
+            rules.append(
+                f"(coalesce({property_alias}.size_m2, 0) = 0"
+                f" OR ({property_alias}.size_m2 > :size_min"
+                f" AND {property_alias}.size_m2 < :size_max))"
+            )
+            params.update(size_min=self.size[0], size_max=self.size[1])
+        return " AND ".join(rules), params
+
+
+# user id -> (settings version, SettingsPredicate)
+predicates = {}
+
+
+def settings_version(settings):
+    return hashlib.sha1(settings.encode()).hexdigest()
+
+
+def settings_predicate(user_id, settings):
+    """Compiled settings of the user, compiled again when they changed."""
+    version = settings_version(settings)
+    cached = predicates.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    predicate = SettingsPredicate(settings)
+    predicates[user_id] = (version, predicate)
+    return predicate
+
+
+def invalidate_settings_predicate(user_id):
+    predicates.pop(user_id, None)
+
+
+class BoundIndex:
+    """Users sorted by one bound, answering which bounds are below/above a value."""
+
+    def __init__(self, bounds):
+        # bounds: [(value, bit)]
+        bounds = sorted(bounds)
+        self.values = [value for value, _ in bounds]
+        self.bits = [bit for _, bit in bounds]
+        self.all = 0
+        self.checkpoints = [0]
+        for i, bit in enumerate(self.bits, start=1):
+            self.all |= bit
+            if i % CHECKPOINT == 0:
+                self.checkpoints.append(self.all)
+
+    def __prefix(self, count):
+        # users of the first `count` sorted bounds
+        bitmap = self.checkpoints[count // CHECKPOINT]
+        for bit in self.bits[count - count % CHECKPOINT : count]:
+            bitmap |= bit
+        return bitmap
+
+    def below(self, value):
+        """Users whose bound is strictly lower than the value."""
+        return self.__prefix(bisect_left(self.values, value))
+
+    def above(self, value):
+        """Users whose bound is strictly greater than the value."""
+        return self.all & ~self.__prefix(bisect_right(self.values, value))
+
+
+class MatchingEngine:
+    def __init__(self):
+        self.settings = {}  # user id -> settings json the indexes were built from
+        self.user_ids = []  # bit position -> user id
+        self.everyone = 0
+        self.cities = {}  # city token -> bitmap
+        self.rooms = {}  # room value -> bitmap
+        self.price_min = BoundIndex([])
+        self.price_max = BoundIndex([])
+        self.size_any = 0  # users without a size range
+        self.size_min = BoundIndex([])
+        self.size_max = BoundIndex([])
+        self.city_cache = {}  # listing city -> bitmap
+
+    def sync(self, users):
+        """
+        Rebuild the indexes when the users or their settings changed.
+        `users` is an iterable of (user id, settings json).
+        """
+        users = dict(users)
+        if users == self.settings:
+            return False
+        self.__build(users)
+        return True
+
+    def __build(self, users):
+        self.settings = users
+        self.user_ids = []
+        self.everyone = 0
+        self.cities = {}
+        self.rooms = {}
+        self.size_any = 0
+        self.city_cache = {}
+        price_min, price_max, size_min, size_max = [], [], [], []
+        for user_id, settings in users.items():
+            predicate = settings_predicate(user_id, settings)
+            if not predicate.is_valid:
+                continue
+            bit = 1 << len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.everyone |= bit
+            for city in predicate.cities:
+                self.cities[city] = self.cities.get(city, 0) | bit
+            for room in predicate.rooms:
+                self.rooms[room] = self.rooms.get(room, 0) | bit
+            price_min.append((predicate.price[0], bit))
+            price_max.append((predicate.price[1], bit))
+            if predicate.size is None:
+                self.size_any |= bit
+            else:
+                size_min.append((predicate.size[0], bit))
+                size_max.append((predicate.size[1], bit))
+        self.price_min = BoundIndex(price_min)
+        self.price_max = BoundIndex(price_max)
+        self.size_min = BoundIndex(size_min)
+        self.size_max = BoundIndex(size_max)
+
+    def __city_users(self, city):
+        if city not in self.city_cache:
+            bitmap = 0
+            for token, users in self.cities.items():
+                if token in city:
+                    bitmap |= users
+            self.city_cache[city] = bitmap
+        return self.city_cache[city]
+
+    def match_bitmap(self, listing):
+        bitmap = self.everyone
+        # is listing.city is contain settings.city?
+        if listing.city:
+            bitmap &= self.__city_users(listing.city)
+        # is listing.rooms is equal to settings.rooms?
+        if bitmap and listing.rooms:
+            bitmap &= self.rooms.get(float(listing.rooms), 0)
+        # is listing.price is between price min and price max?
+        if bitmap and listing.price:
+            price = float(listing.price)
+            bitmap &= self.price_min.below(price) & self.price_max.above(price)
+        # is listing.size is between size min and size max?
+        if bitmap and listing.size_m2:
+            size = float(listing.size_m2)
+            bitmap &= self.size_any | (
+                self.size_min.below(size) & self.size_max.above(size)
+            )
+        return bitmap
+
+    def match(self, listing):
+        """Ids of the users whose settings accept the listing."""
+        bitmap = self.match_bitmap(listing)
+        user_ids = []
+        while bitmap:
+            low = bitmap & -bitmap
+            user_ids.append(self.user_ids[low.bit_length() - 1])
+            bitmap ^= low
+        return user_ids
+
+    def pairs(self, listings):
+        """Yield (listing, user id) for every match."""
+        for listing in listings:
+            for user_id in self.match(listing):
+                yield listing, user_id
@@ -7,6 +7,7 @@ import uuid
 import json
 
 from constants import DEFAULT_SETTINGS
+from matching import SettingsPredicate, settings_predicate
 
 Base = declarative_base()
 
@@ -25,35 +26,12 @@ class User(Base):
 
     queues = relationship("Queue", back_populates="user")
 
-    def settings_as_where_clause(self):
-        settings = json.loads(self.settings)
-        city = settings["city"]
-        price_min, price_max = settings["price"].split("-")
-        size_min, size_max = settings["size"].split("-")
-        # city clause
-        cities = settings["city"].split(",")
-        if len(cities) > 1:
-            city_clause = " OR ".join([f"city = '{city}'" for city in cities])
-            city_clause = f"({city_clause})"
-        else:
-            city_clause = f"city = '{cities[0]}'"
-        # rooms clause
-        rooms = settings["rooms"].split(",")
-        if len(rooms) > 1:
-            rooms_clause = " OR ".join([f"rooms = {room}" for room in rooms])
-            rooms_clause = f"({rooms_clause})"
-        else:
-            rooms_clause = f"rooms = {rooms[0]}"
-        # rules
-        rules = [
-            f"{city_clause}",
-            f"price >= {price_min}",
-            f"price <= {price_max}",
-            f"size_m2 >= {size_min}",
-            f"size_m2 <= {size_max}",
-            f"{rooms_clause}",
-        ]
-        return " AND ".join(rules)
+    def settings_as_where_clause(
+        self, listing_alias="listings", property_alias="properties"
+    ):
+        # parameterized clause and its params, compiled once per settings
+        predicate = settings_predicate(self.id, self.settings)
+        return predicate.as_where_clause(listing_alias, property_alias)
 
 
 class Queue(Base):
@@ -128,6 +106,9 @@ class CustomListing:
         self.first_seen_at = kwargs.get("first_seen_at", dt.now())
 
     def validate_settings(self, settings):
+        # compiled settings skip the json parsing
+        if isinstance(settings, SettingsPredicate):
+            return settings.matches(self)
         settings = json.loads(settings)
         price_min, price_max = settings["price"].split("-")
         size_min, size_max = settings["size"].split("-")
@@ -2,7 +2,10 @@ from telegram import Bot
 from tqdm import tqdm
 from database import get_db
 from sqlalchemy import text
-from models import CustomListing, User, Queue, Listing
+from models import CustomListing, User
+from matching import MatchingEngine
+from batch_matching import BatchMatcher
+from queries import insert_queue_pairs, queue_insert_matches_query
 from decouple import config
 import asyncio
 
@@ -35,7 +38,27 @@ async def send_message(chat_id, text):
         print("Error sending message:", e)
 
 
+def create_queue_sql():
+    # match and insert in the database, nothing crosses the wire
+    db = next(get_db())
+    today = dt.now().strftime(r"%Y-%m-%d")
+    try:
+        result = db.connection().exec_driver_sql(
+            queue_insert_matches_query,
+            dict(since=today, source="%halooglasi.com%"),
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("Error creating queue::create_queue_sql::", e)
+        return 0
+    print("Queued listings:", result.rowcount)
+    return result.rowcount
+
+
 def create_queue():
+    if config("QUEUE_MATCHER", default="index") == "sql":
+        return create_queue_sql()
     db = next(get_db())
     today = dt.now().strftime(r"%Y-%m-%d")
     users = db.query(User).all()
@@ -76,25 +99,31 @@ def create_queue():
     # convert raw data into custom listings
     listings = [dict(zip(cols, listing)) for listing in listings]
     listings = [CustomListing(**item) for item in listings]
+    # compile the users settings once
+    if config("QUEUE_MATCHER", default="index") == "numpy":
+        matcher = BatchMatcher()
+    else:
+        matcher = MatchingEngine()
+    matcher.sync((user.id, user.settings) for user in users)
     # send all the listings via telegram bot as notifications
-    for user in users:
-        user_queues = db.query(Queue.listing_id).filter(Queue.user_id == user.id).all()
-        user_queues = [u[0] for u in user_queues]
-        for l in tqdm(listings, desc="Adding to queue table"):
-            if l.id not in user_queues and l.validate_settings(user.settings):
-                # create queue
-                queue = Queue(listing_id=l.id, user_id=user.id)
-                try:
-                    db.add(queue)
-                    db.commit()
-                except Exception:
-                    db.rollback()
+    pairs = tqdm(matcher.pairs(listings), desc="Adding to queue table")
+    pairs = ((str(l.id), str(user_id)) for l, user_id in pairs)
+    try:
+        cursor = db.connection().connection.cursor()
+        inserted = insert_queue_pairs(cursor, pairs)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("Error creating queue::create_queue::", e)
+        return 0
+    print("Queued listings:", inserted)
+    return inserted
 
 
 def main():
     db = next(get_db())
     user = db.query(User).filter(User.username == "ekkyarmandi").first()
-    user_settings = user.settings_as_where_clause()
+    where_clause, params = user.settings_as_where_clause()
     # query listings that match with user settings
     cols = [
         "url",
@@ -117,10 +146,10 @@ def main():
             properties.rooms
         FROM listings_listing as listings
         JOIN listings_property as properties ON listings.id = properties.listing_id
-        WHERE {user_settings};
+        WHERE {where_clause};
         """
     )
-    r = db.execute(q)
+    r = db.execute(q, params)
     listing_item = dict(zip(cols, r.fetchone()))
     listing = CustomListing(**listing_item)
     # employ telegram bot for sending the message
@@ -1,11 +1,19 @@
 from telegram import Bot
+from telegram.error import RetryAfter
 from decouple import config
-from database import get_db
-from models import Queue, CustomListing
+from database import AsyncSessionLocal, async_engine, engine
+from models import CustomListing
+from sqlalchemy import event, text
+from argparse import ArgumentParser
+from collections import OrderedDict
+from datetime import timedelta
 import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
+import psycopg2
 import shutil
+import sys
+import time
 
 TOKEN = config("TELEGRAMBOT_TOKEN")
 bot = Bot(token=TOKEN)
@@ -32,50 +40,507 @@ logging.basicConfig(
 )
 
 
-async def send_message(chat_id, text):
-    try:
-        await bot.send_message(chat_id=chat_id, text=text)
-        return True
-    except Exception as e:
-        print("Error sending message:", e)
+# Telegram limits: about 30 messages per second overall, 1 per second per chat
+GLOBAL_RATE = config("SENDER_GLOBAL_RATE", default=30, cast=float)
+CHAT_RATE = config("SENDER_CHAT_RATE", default=1, cast=float)
+BATCH_SIZE = config("SENDER_BATCH_SIZE", default=1000, cast=int)
+# Rows of one chat per fetch, a chat with a long backlog leaves room to the others
+CHAT_BATCH_SIZE = config("SENDER_CHAT_BATCH_SIZE", default=20, cast=int)
+# Fetches are at least this far apart while the workers free room
+FEED_INTERVAL = config("SENDER_FEED_INTERVAL", default=1, cast=float)
+# In daemon mode a sweep runs this often even without notifications
+SWEEP_INTERVAL = config("SENDER_SWEEP_INTERVAL", default=60, cast=float)
+# Channel notified by the listings_queue insert trigger
+QUEUE_CHANNEL = "listings_queue"
+# Users with the digest setting get up to this many listings per message
+DIGEST_SIZE = config("SENDER_DIGEST_SIZE", default=10, cast=int)
+DIGEST_SEPARATOR = "\n\n➖➖➖\n\n"
+MESSAGE_MAX_LENGTH = 4096
+# Memory taken by the rendered messages kept between batches
+MESSAGE_CACHE_BYTES = config(
+    "SENDER_MESSAGE_CACHE_BYTES", default=8 * 1024 * 1024, cast=int
+)
+MAX_ATTEMPTS = 3
+# Delivered rows are marked sent in groups of this many while a chat goes out
+MARK_SENT_SIZE = config("SENDER_MARK_SENT_SIZE", default=5, cast=int)
+# Undelivered rows are fetched again after a delay doubling on each failure
+RETRY_DELAY = config("SENDER_RETRY_DELAY", default=30, cast=float)
+RETRY_MAX_DELAY = config("SENDER_RETRY_MAX_DELAY", default=3600, cast=float)
+# Session advisory lock held by the running sender, a second one exits
+SENDER_LOCK_QUERY = "SELECT pg_try_advisory_lock(hashtext('listings_queue_sender'));"
+SENDER_UNLOCK_QUERY = "SELECT pg_advisory_unlock(hashtext('listings_queue_sender'));"
+
+
+# Unsent queues, the oldest :per_chat of each idle chat. The listings they point
+# to are loaded once per batch
+fetch_queues_query = """
+SELECT id, chat_id, listing_id, digest
+FROM (
+    SELECT
+        q.id,
+        u.chat_id,
+        q.listing_id,
+        q.created_at,
+        coalesce(u.settings_json -> 'digest' = 'true'::jsonb, false) AS digest,
+        row_number() OVER (PARTITION BY q.user_id ORDER BY q.created_at) AS position
+    FROM listings_queue q
+    JOIN bot_user u ON u.id = q.user_id
+    WHERE q.is_sent = false AND q.id <> ALL(CAST(:failed AS uuid[]))
+    AND u.chat_id <> ALL(CAST(:busy AS text[]))
+    AND EXISTS (SELECT 1 FROM listings_property lp WHERE lp.listing_id = q.listing_id)
+) q
+WHERE position <= :per_chat
+ORDER BY created_at
+LIMIT :limit;
+"""
+
+fetch_listings_query = """
+SELECT
+    ll.id,
+    ll.url,
+    ll.city,
+    ll.price,
+    ll.municipality,
+    ll.micro_location,
+    ll.first_seen_at,
+    lp.size_m2,
+    lp.rooms
+FROM listings_listing ll
+JOIN LATERAL (
+    SELECT size_m2, rooms FROM listings_property
+    WHERE listing_id = ll.id LIMIT 1
+) lp ON true
+WHERE ll.id = ANY(CAST(:ids AS uuid[]));
+"""
+
+mark_sent_query = """
+UPDATE listings_queue SET is_sent = true, updated_at = now()
+WHERE id = ANY(CAST(:ids AS uuid[]));
+"""
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def is_full(self):
+        self.__refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        # the lock queues the waiters in arrival order
+        async with self.lock:
+            self.__refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.__refill()
+            self.tokens -= 1
+
+
+def message_length(text):
+    # telegram counts utf-16 code units, an emoji can take two
+    return len(text.encode("utf-16-le")) // 2
+
+
+def digests(messages, size=DIGEST_SIZE):
+    """
+    Bundle the (queue id, message) of a chat into ([queue ids], text) holding
+    up to `size` listings each and fitting a telegram message.
+    """
+    bundles = []
+    queue_ids, texts, length = [], [], 0
+    for queue_id, message in messages:
+        header = digest_header(len(texts) + 1)
+        extra = message_length(message) + message_length(DIGEST_SEPARATOR)
+        too_long = message_length(header) + length + extra > MESSAGE_MAX_LENGTH
+        if texts and (len(texts) >= size or too_long):
+            bundles.append((queue_ids, digest_text(texts)))
+            queue_ids, texts, length = [], [], 0
+        queue_ids.append(queue_id)
+        texts.append(message)
+        length += message_length(message) + message_length(DIGEST_SEPARATOR)
+    if texts:
+        bundles.append((queue_ids, digest_text(texts)))
+    return bundles
+
+
+def digest_header(count):
+    return f"🔔 {count} new listings\n\n" if count > 1 else ""
+
+
+def digest_text(texts):
+    return digest_header(len(texts)) + DIGEST_SEPARATOR.join(texts)
+
+
+class MessageCache:
+    """
+    Rendered listing messages, least recently used first out once the texts
+    take more than `max_bytes`. An entry is rendered again when any of the
+    rendered fields (price and location included) changed.
+    """
+
+    fields = [
+        "url",
+        "city",
+        "price",
+        "municipality",
+        "micro_location",
+        "first_seen_at",
+        "size_m2",
+        "rooms",
+    ]
+
+    def __init__(self, max_bytes=MESSAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # listing id -> (values, message)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, listing_id, values):
+        values = tuple(values)
+        entry = self.entries.get(listing_id)
+        if entry and entry[0] == values:
+            self.hits += 1
+            self.entries.move_to_end(listing_id)
+            return entry[1]
+        self.misses += 1
+        if entry:
+            self.size -= sys.getsizeof(entry[1])
+        listing = CustomListing(**dict(zip(self.fields, values)))
+        message = listing.as_markdown()
+        self.entries[listing_id] = (values, message)
+        self.entries.move_to_end(listing_id)
+        self.size += sys.getsizeof(message)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= sys.getsizeof(evicted)
+        return message
+
+
+class QueueListener:
+    """LISTEN on the queue channel, wait() returns once rows were inserted."""
+
+    def __init__(self, channel=QUEUE_CHANNEL):
+        self.channel = channel
+        self.conn = None
+        self.notified = asyncio.Event()
+
+    def __open(self):
+        # a dedicated connection, detached from the pool for good
+        connection = engine.raw_connection()
+        connection.detach()
+        conn = connection.dbapi_connection
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel};")
+        return conn
+
+    async def connect(self):
+        # the blocking connect runs in a thread, the senders keep going
+        loop = asyncio.get_running_loop()
+        self.conn = await loop.run_in_executor(None, self.__open)
+        loop.add_reader(self.conn.fileno(), self.__on_readable)
+        logger.info(f"Listening on {self.channel}")
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+
+    def __on_readable(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error as e:
+            # lost the connection, the sweep covers the gap until reconnected
+            logger.warning(f"Queue listener disconnected: {e}")
+            self.close()
+            self.notified.set()
+            return
+        if self.conn.notifies:
+            self.conn.notifies.clear()
+            self.notified.set()
+
+    async def wait(self, timeout):
+        if self.conn is None:
+            try:
+                await self.connect()
+            except Exception as e:
+                logger.warning(f"Queue listener cannot connect: {e}")
+        try:
+            await asyncio.wait_for(self.notified.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass  # periodic sweep
+        self.notified.clear()
+
+
+class Sender:
+    """
+    Continuous scheduler: the fetched queues go to one worker per chat, the
+    workers share the global rate, so a slow chat never holds the others back.
+    The delivered rows are marked sent every few messages as they go out.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}  # chat id -> TokenBucket
+        self.failed = {}  # queue id -> (failures, retry at), skipped until then
+        self.in_flight = set()  # queue ids handed to a worker, not marked yet
+        self.pending = {}  # chat id -> [(queue id, message)] waiting for its worker
+        self.digest_chats = set()  # chats of the users who want digests
+        self.workers = {}  # chat id -> worker task
+        self.progress = asyncio.Event()  # set whenever a worker freed some room
+        self.queries = 0  # statements sent since the start
+        self.pulled = 0  # queue rows fetched since the start
+        self.messages = MessageCache()
+        event.listen(
+            async_engine.sync_engine, "before_cursor_execute", self.__count_query
+        )
+
+    def __chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) > 10000:
+                # forget the chats idle long enough to have a full bucket
+                self.chat_buckets = {
+                    key: bucket
+                    for key, bucket in self.chat_buckets.items()
+                    if not bucket.is_full()
+                }
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return self.chat_buckets[chat_id]
+
+    async def deliver(self, chat_id, text):
+        for _ in range(MAX_ATTEMPTS):
+            await self.__chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                # flood control, wait as long as telegram asks
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Flood control, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+            except Exception as e:
+                logger.error(f"Error sending message to {chat_id}: {e}")
+                return False
         return False
 
+    async def send_chat(self, chat_id, messages, digest=False):
+        # messages of one chat go in order, the chats run concurrently. The
+        # delivered rows are marked every few messages, the rest at the end,
+        # also on cancel, so a stop never sends them twice
+        sent = []  # delivered, not marked yet
+        bundles = digests(messages) if digest else [([q], t) for q, t in messages]
+        try:
+            for queue_ids, text in bundles:
+                if await self.deliver(chat_id, text):
+                    sent.extend(queue_ids)
+                    for queue_id in queue_ids:
+                        self.failed.pop(queue_id, None)
+                else:
+                    self.__fail(queue_ids)
+                if len(sent) >= MARK_SENT_SIZE:
+                    await self.__mark_sent(sent)
+                    sent = []
+        finally:
+            await self.__mark_sent(sent)
+
+    async def __mark_sent(self, queue_ids):
+        try:
+            await self.mark_sent(queue_ids)
+            if queue_ids:
+                logger.info(f"{len(queue_ids)} queued listings has been sent")
+        except Exception as e:
+            logger.error(f"Error marking queues as sent: {e}")
+
+    def __fail(self, queue_ids):
+        now = time.monotonic()
+        for queue_id in queue_ids:
+            failures = self.failed.get(queue_id, (0, now))[0] + 1
+            delay = min(RETRY_DELAY * 2 ** min(failures - 1, 16), RETRY_MAX_DELAY)
+            self.failed[queue_id] = (failures, now + delay)
 
-async def send_queues():
-    db = next(get_db())
-    queues = db.query(Queue).filter(Queue.is_sent == False).limit(20).all()
-    count = 0
-    for queue in queues:
-        chat_id = queue.user.chat_id
-        prop = queue.listing.property
-        if len(prop) == 0:
-            continue
-        prop = prop[0]
-        listing_item = {
-            "url": queue.listing.url,
-            "city": queue.listing.city,
-            "price": queue.listing.price,
-            "municipality": queue.listing.municipality,
-            "micro_location": queue.listing.micro_location,
-            "size_m2": prop.size_m2,
-            "rooms": prop.rooms,
-            "first_seen_at": queue.listing.first_seen_at,
+    def __retry_later(self):
+        # the failed rows still waiting for their retry, the entries left long
+        # after it (row sent or deleted meanwhile) are forgotten
+        now = time.monotonic()
+        self.failed = {
+            queue_id: (failures, retry_at)
+            for queue_id, (failures, retry_at) in self.failed.items()
+            if retry_at > now - RETRY_MAX_DELAY
         }
-        listing = CustomListing(**listing_item)
-        message = listing.as_markdown()
+        return {
+            queue_id
+            for queue_id, (_, retry_at) in self.failed.items()
+            if retry_at > now
+        }
+
+    def __count_query(self, *args):
+        self.queries += 1
+
+    async def fetch_batch(self, db, limit=BATCH_SIZE):
+        # unsent queues grouped by chat: chat id -> [(queue id, message)], and
+        # the chats of the users who want digests. LIMIT bounds the batch, the
+        # rows are read at once. The rows in flight belong to the chats with a
+        # worker, those are skipped until it is done
+        result = await db.execute(
+            text(fetch_queues_query),
+            dict(
+                failed=list(self.__retry_later()),
+                busy=[str(chat_id) for chat_id in self.workers],
+                per_chat=CHAT_BATCH_SIZE,
+                limit=limit,
+            ),
+        )
+        queues = result.fetchall()
+        # render every listing once, whatever its number of recipients
+        listing_ids = list({str(queue[2]) for queue in queues})
+        result = await db.execute(text(fetch_listings_query), dict(ids=listing_ids))
+        messages = {}
+        for listing_id, *values in result:
+            messages[str(listing_id)] = self.messages.render(listing_id, values)
+        chats = {}
+        digest_chats = set()
+        for queue_id, chat_id, listing_id, digest in queues:
+            message = messages.get(str(listing_id))
+            if message is None:
+                continue
+            chats.setdefault(chat_id, []).append((str(queue_id), message))
+            if digest:
+                digest_chats.add(chat_id)
+        return len(queues), chats, digest_chats
+
+    async def mark_sent(self, queue_ids):
+        if not queue_ids:
+            return
+        async with AsyncSessionLocal() as db:
+            await db.execute(text(mark_sent_query), dict(ids=queue_ids))
+            await db.commit()
+
+    async def feed(self, limit):
+        """Hand the unsent queues to the chat workers, returns the rows pulled."""
+        async with AsyncSessionLocal() as db:
+            pulled, chats, digest_chats = await self.fetch_batch(db, limit)
+        for chat_id, messages in chats.items():
+            self.in_flight.update(queue_id for queue_id, _ in messages)
+            self.pending.setdefault(chat_id, []).extend(messages)
+            if chat_id in digest_chats:
+                self.digest_chats.add(chat_id)
+            else:
+                self.digest_chats.discard(chat_id)
+            if chat_id not in self.workers:
+                self.workers[chat_id] = asyncio.create_task(self.__work(chat_id))
+        self.pulled += pulled
+        if self.pulled:
+            logger.info(
+                f"{self.queries} queries for {self.pulled} messages, "
+                f"{self.queries / self.pulled:.3f} queries per message"
+            )
+        logger.info(
+            f"message cache: {self.messages.hits} hits, "
+            f"{self.messages.misses} renders, {self.messages.size} bytes"
+        )
+        return pulled
+
+    async def __work(self, chat_id):
+        # sends the pending messages of one chat until there are none left
+        try:
+            while self.pending.get(chat_id):
+                messages = self.pending.pop(chat_id)
+                digest = chat_id in self.digest_chats
+                try:
+                    await self.send_chat(chat_id, messages, digest)
+                except Exception as e:
+                    logger.error(f"Error sending queues of chat {chat_id}: {e}")
+                finally:
+                    # also on cancel, the undelivered rows are fetched again
+                    self.in_flight.difference_update(q for q, _ in messages)
+                    self.progress.set()
+        finally:
+            del self.workers[chat_id]
+
+    async def run(self, daemon=False):
+        # nothing claims the queue rows, so only one sender may run at a time
+        try:
+            async with async_engine.connect() as lock:
+                if not await lock.scalar(text(SENDER_LOCK_QUERY)):
+                    logger.info("Another sender is running, exiting")
+                    return
+                try:
+                    await self.__run(daemon)
+                finally:
+                    await lock.execute(text(SENDER_UNLOCK_QUERY))
+        finally:
+            await async_engine.dispose()
+
+    async def __run(self, daemon):
+        listener = QueueListener() if daemon else None
+        listening = None  # the listener wait, kept until it returns
+        fetched_at = 0
+        try:
+            while True:
+                room = BATCH_SIZE - len(self.in_flight)
+                if room > 0:
+                    await asyncio.sleep(fetched_at + FEED_INTERVAL - time.monotonic())
+                    fetched_at = time.monotonic()
+                    self.progress.clear()
+                    pulled = await self.feed(room)
+                    if pulled == room:
+                        continue
+                else:
+                    self.progress.clear()
+                if not daemon and not self.workers:
+                    return
+                # fetch again once a worker is done, its chat may have more
+                # rows, or on new queues and the periodic sweep
+                waits = [asyncio.create_task(self.progress.wait())]
+                if daemon:
+                    if listening is None or listening.done():
+                        listening = asyncio.create_task(listener.wait(SWEEP_INTERVAL))
+                    waits.append(listening)
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+                waits[0].cancel()
+        finally:
+            if listening:
+                listening.cancel()
+            if listener:
+                listener.close()
+            # stopped early, the workers mark what they delivered and stop
+            for worker in list(self.workers.values()):
+                worker.cancel()
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
 
-        # Send message and update queue if successful
-        success = await send_message(chat_id=chat_id, text=message)
-        if success:
-            count += 1
-            queue.is_sent = True
-            db.commit()
 
-    logger.info(f"{count} queued listings has been sent")
+async def send_queues(daemon=False):
+    await Sender().run(daemon)
 
 
 async def main():
-    await send_queues()
+    parser = ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="keep sending new queues")
+    args = parser.parse_args()
+    await send_queues(daemon=args.daemon)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+"""
+Per-process cache of the parsed user settings, keyed by chat id.
+
+Navigating the settings menu reads the cache only, the database is queried
+on a miss or once an entry is older than SETTINGS_CACHE_TTL seconds, and
+save_settings writes the saved settings through.
+"""
+
+from copy import deepcopy
+from decouple import config
+from sqlalchemy import select
+import json
+import time
+
+from database import AsyncSessionLocal
+from models import User
+
+SETTINGS_CACHE_TTL = config("SETTINGS_CACHE_TTL", default=300, cast=int)
+
+# chat id -> (expires at, parsed settings)
+cache = {}
+
+
+def parse_settings(settings: str) -> dict:
+    """Settings json as the handlers use it, rooms and city as lists."""
+    settings = json.loads(settings)
+    if isinstance(settings["rooms"], str):
+        settings["rooms"] = settings["rooms"].split(",")
+    if isinstance(settings["city"], str):
+        settings["city"] = settings["city"].split(",")
+    return settings
+
+
+def set_settings(chat_id: str, settings: str):
+    cache[chat_id] = (time.monotonic() + SETTINGS_CACHE_TTL, parse_settings(settings))
+
+
+def invalidate_settings(chat_id: str):
+    cache.pop(chat_id, None)
+
+
+async def get_settings(chat_id: str) -> dict:
+    """Copy of the user settings, the handlers are free to edit it."""
+    cached = cache.get(chat_id)
+    if cached and cached[0] > time.monotonic():
+        return deepcopy(cached[1])
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).where(User.chat_id == chat_id))
+    set_settings(chat_id, user.settings)
+    return deepcopy(cache[chat_id][1])
@@ -0,0 +1,224 @@
+"""
+The sql matching must agree with SettingsPredicate.matches, the database
+tests run against TEST_DB_URL on temporary tables and are skipped without it.
+"""
+
+from pathlib import Path
+from types import SimpleNamespace
+import importlib.util
+import inspect
+import json
+import os
+import random
+
+import pytest
+
+from matching import MatchingEngine, SettingsPredicate, parse_settings
+import queries
+from queries import user_settings_cte
+
+
+def make_settings(**kwargs):
+    settings = dict(
+        city="Beograd",
+        price="50000-150000",
+        size="45-120",
+        rooms="2,3",
+        is_enabled=True,
+    )
+    settings.update(kwargs)
+    return json.dumps(settings)
+
+
+CRAWLER = Path(__file__).resolve().parent.parent / "crawler"
+CRAWLER_MODELS = CRAWLER / "models"
+CRAWLER_QUEUE = CRAWLER / "real_estate_scraper" / "templates" / "sql" / "queue.py"
+
+
+def make_listing(**kwargs):
+    listing = dict(id=0, city="Beograd", price=100000, size_m2=60, rooms=2)
+    listing.update(kwargs)
+    return SimpleNamespace(**listing)
+
+
+@pytest.fixture
+def db():
+    sqlalchemy = pytest.importorskip("sqlalchemy")
+    url = os.environ.get("TEST_DB_URL")
+    if not url:
+        pytest.skip("TEST_DB_URL is not set")
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as connection:
+        # temporary tables shadow the real ones and go with the rollback
+        yield connection
+        connection.rollback()
+    engine.dispose()
+
+
+def test_empty_city_matches_every_city():
+    predicate = SettingsPredicate(make_settings(city=""))
+    assert predicate.cities == [""]
+    assert predicate.matches(make_listing(city="Novi Sad"))
+
+
+def test_user_settings_cte_parses_cities_as_python(db):
+    from sqlalchemy import text
+
+    db.execute(text("CREATE TEMP TABLE bot_user (id int, settings_json jsonb);"))
+    cities = ["", "Beograd", "Beograd,Novi Sad", "Beograd,"]
+    for user_id, city in enumerate(cities):
+        db.execute(
+            text("INSERT INTO bot_user VALUES (:id, CAST(:settings AS jsonb));"),
+            dict(id=user_id, settings=make_settings(city=city)),
+        )
+    q = text(
+        f"WITH {user_settings_cte} "
+        "SELECT user_id, cities FROM user_settings ORDER BY user_id;"
+    )
+    rows = db.execute(q).fetchall()
+    assert [row.cities for row in rows] == [
+        parse_settings(make_settings(city=city))["cities"] for city in cities
+    ]
+
+
+# missing (None or 0) values skip their check, the save-settings preview and
+# the queue count them as matches like validate_settings does
+LISTINGS = [
+    make_listing(id=1),
+    make_listing(id=2, price=None),
+    make_listing(id=3, price=0),
+    make_listing(id=4, size_m2=None),
+    make_listing(id=5, size_m2=0),
+    make_listing(id=6, rooms=None),
+    make_listing(id=7, rooms=0),
+    make_listing(id=8, city=None),
+    make_listing(id=9, price=200000),
+    make_listing(id=10, size_m2=150),
+    make_listing(id=11, rooms=4),
+    make_listing(id=12, city="Novi Sad"),
+]
+
+
+def test_missing_values_skip_their_check():
+    predicate = SettingsPredicate(make_settings())
+    matched = {listing.id for listing in LISTINGS if predicate.matches(listing)}
+    assert matched == {1, 2, 3, 4, 5, 6, 7, 8}
+
+
+def test_where_clause_matches_like_python(db):
+    from sqlalchemy import text
+
+    db.execute(
+        text(
+            "CREATE TEMP TABLE listings_listing (id int, city text, price numeric);"
+        )
+    )
+    db.execute(
+        text(
+            "CREATE TEMP TABLE listings_property "
+            "(listing_id int, size_m2 float8, rooms float8);"
+        )
+    )
+    for listing in LISTINGS:
+        db.execute(
+            text("INSERT INTO listings_listing VALUES (:id, :city, :price);"),
+            vars(listing),
+        )
+        db.execute(
+            text("INSERT INTO listings_property VALUES (:id, :size_m2, :rooms);"),
+            vars(listing),
+        )
+    for settings in [make_settings(), make_settings(size="-"), make_settings(city="")]:
+        predicate = SettingsPredicate(settings)
+        where_clause, params = predicate.as_where_clause()
+        q = text(
+            f"""
+            SELECT ll.id
+            FROM listings_listing ll
+            JOIN listings_property lp ON lp.listing_id = ll.id
+            WHERE {where_clause};
+            """
+        )
+        matched = {row.id for row in db.execute(q, params)}
+        assert matched == {l.id for l in LISTINGS if predicate.matches(l)}
+
+
+def random_settings(rng):
+    return make_settings(
+        city=",".join(rng.sample(["Beograd", "Novi Sad", "Niš", "Sad", ""], 2)),
+        price=rng.choice(["50000-150000", "0-100000", "100000-300000"]),
+        size=rng.choice(["45-120", "60-80", "-", "50-"]),
+        rooms=rng.choice(["2,3", "1.5", "3.0,4", "2"]),
+        is_enabled=rng.random() > 0.1,
+    )
+
+
+def random_listing(rng, listing_id):
+    # values on the settings bounds too, the bounds are strict
+    return make_listing(
+        id=listing_id,
+        city=rng.choice(["Beograd", "Novi Sad", "Niš", "Kragujevac", "", None]),
+        price=rng.choice([0, None, 50000, 75000, 100000, 150000, 250000]),
+        size_m2=rng.choice([0, None, 45, 60, 70, 80, 120, 150]),
+        rooms=rng.choice([0, None, 1.5, 2, 3, 4]),
+    )
+
+
+def test_engines_match_like_validate_settings():
+    pytest.importorskip("sqlalchemy")
+    from models import CustomListing
+
+    rng = random.Random(0)
+    users = {user_id: random_settings(rng) for user_id in range(200)}
+    listings = [random_listing(rng, listing_id) for listing_id in range(300)]
+    expected = {
+        (listing.id, user_id)
+        for listing in listings
+        for user_id, settings in users.items()
+        if CustomListing.validate_settings(listing, settings)
+    }
+    engine = MatchingEngine()
+    engine.sync(users.items())
+    assert {(l.id, user_id) for l, user_id in engine.pairs(listings)} == expected
+    batch_matching = pytest.importorskip("batch_matching")
+    matcher = batch_matching.BatchMatcher(chunk_size=64)
+    matcher.sync(users.items())
+    assert {(l.id, user_id) for l, user_id in matcher.pairs(listings)} == expected
+
+
+def test_matching_is_the_crawler_copy():
+    # the bot and the crawler deploy apart, each ships its own copy
+    crawler_copy = CRAWLER_MODELS / "matching.py"
+    if not crawler_copy.exists():
+        pytest.skip("crawler is not checked out")
+    bot_copy = Path(__file__).resolve().parent / "matching.py"
+    assert bot_copy.read_text() == crawler_copy.read_text()
+
+
+def test_batch_matching_is_the_crawler_copy():
+    crawler_copy = CRAWLER_MODELS / "batch_matching.py"
+    if not crawler_copy.exists():
+        pytest.skip("crawler is not checked out")
+    bot_copy = Path(__file__).resolve().parent / "batch_matching.py"
+    # only the import of the matching module differs
+    assert bot_copy.read_text() == crawler_copy.read_text().replace(
+        "from models.matching import", "from matching import"
+    )
+
+
+def test_queries_are_the_crawler_queue_templates():
+    if not CRAWLER_QUEUE.exists():
+        pytest.skip("crawler is not checked out")
+    spec = importlib.util.spec_from_file_location("crawler_queue", CRAWLER_QUEUE)
+    crawler_queue = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(crawler_queue)
+    assert queries.user_settings_cte == crawler_queue.user_settings_cte
+    assert queries.queue_insert_pairs_query == crawler_queue.queue_insert_pairs_query
+    assert inspect.getsource(queries.insert_queue_pairs) == inspect.getsource(
+        crawler_queue.insert_queue_pairs
+    )
+    # the crawler queues the listings past its watermark, the bot those created
+    # since a date, the matching itself is the same
+    bot_join = queries.queue_insert_matches_query.split("\nWHERE ")[0]
+    crawler_join = crawler_queue.queue_insert_matches_query.split("\nWHERE ")[0]
+    assert bot_join == crawler_join
@@ -0,0 +1,136 @@
+"""
+Vectorized matching of a batch of listings against every user's settings.
+
+The settings are kept as arrays (price and size bounds, a users x rooms and
+a users x city tokens table), a chunk of listings is matched in one numpy
+pass giving a (listing, user) boolean matrix. Same semantics as
+CustomListing.validate_settings: strict bounds, a missing (falsy) listing
+value skips its check, a user without a size range accepts any size.
+"""
+
+import numpy as np
+
+from models.matching import settings_predicate
+
+CHUNK_SIZE = 512  # listings per pass, bounds the matrix memory
+
+
+class BatchMatcher:
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.settings = {}  # user id -> settings json the arrays were built from
+        self.user_ids = np.array([], dtype=object)
+        self.price_min = np.array([])
+        self.price_max = np.array([])
+        self.has_size = np.array([], dtype=bool)
+        self.size_min = np.array([])
+        self.size_max = np.array([])
+        self.room_values = np.array([])  # sorted, row i of the rooms table
+        self.room_users = np.zeros((2, 0), dtype=bool)
+        self.city_tokens = []
+        self.city_users = np.zeros((0, 0), dtype=bool)
+        self.city_cache = {}  # listing city -> users mask
+
+    def sync(self, users):
+        """Rebuild the arrays when the users or their settings changed."""
+        users = dict(users)
+        if users == self.settings:
+            return False
+        self.__build(users)
+        return True
+
+    def __build(self, users):
+        self.settings = users
+        parsed = []
+        for user_id, settings in users.items():
+            predicate = settings_predicate(user_id, settings)
+            if predicate.is_valid:
+                parsed.append((user_id, predicate))
+        self.user_ids = np.array([user_id for user_id, _ in parsed], dtype=object)
+        self.price_min = np.array([p.price[0] for _, p in parsed], dtype=float)
+        self.price_max = np.array([p.price[1] for _, p in parsed], dtype=float)
+        self.has_size = np.array([p.size is not None for _, p in parsed], dtype=bool)
+        sizes = [p.size or (np.nan, np.nan) for _, p in parsed]
+        self.size_min = np.array([size[0] for size in sizes], dtype=float)
+        self.size_max = np.array([size[1] for size in sizes], dtype=float)
+        # rooms and city tokens as (value, user) tables, the two last rows of
+        # the rooms table are for an unknown room count and a missing one
+        rooms = sorted({room for _, p in parsed for room in p.rooms})
+        room_rows = {room: i for i, room in enumerate(rooms)}
+        self.room_values = np.array(rooms, dtype=float)
+        self.room_users = np.zeros((len(rooms) + 2, len(parsed)), dtype=bool)
+        self.room_users[-1] = True
+        tokens = sorted({city for _, p in parsed for city in p.cities})
+        token_index = {token: i for i, token in enumerate(tokens)}
+        self.city_tokens = tokens
+        self.city_users = np.zeros((len(tokens), len(parsed)), dtype=bool)
+        for i, (_, p) in enumerate(parsed):
+            for room in p.rooms:
+                self.room_users[room_rows[room], i] = True
+            for city in p.cities:
+                self.city_users[token_index[city], i] = True
+        self.city_cache = {}
+
+    def __city_users(self, city):
+        # users with a city token contained in the listing city
+        if city not in self.city_cache:
+            tokens = np.array([token in city for token in self.city_tokens], bool)
+            self.city_cache[city] = self.city_users[tokens].any(axis=0)
+        return self.city_cache[city]
+
+    def __city_mask(self, listings):
+        # one row per distinct city of the chunk, indexed by the listing codes
+        cities = np.array([l.city or "" for l in listings], dtype=object)
+        uniques, codes = np.unique(cities, return_inverse=True)
+        table = np.ones((len(uniques), len(self.user_ids)), dtype=bool)
+        for i, city in enumerate(uniques):
+            # a listing without city skips the check
+            if city:
+                table[i] = self.__city_users(city)
+        return table[codes.reshape(-1)]
+
+    def __room_mask(self, rooms):
+        # row of each listing room count in the rooms table
+        rooms = rooms[:, 0]
+        rows = np.searchsorted(self.room_values, rooms)
+        found = rows < len(self.room_values)
+        found[found] = self.room_values[rows[found]] == rooms[found]
+        rows = np.where(found, rows, len(self.room_values))
+        rows = np.where(np.isnan(rooms), len(self.room_values) + 1, rows)
+        return self.room_users[rows]
+
+    @staticmethod
+    def __values(listings, field):
+        # missing (falsy) values are nan, their check is skipped
+        values = [getattr(l, field) for l in listings]
+        return np.array(
+            [float(value) if value else np.nan for value in values], dtype=float
+        )[:, None]
+
+    def match_matrix(self, listings):
+        """Boolean (listings x users) matrix of the matches."""
+        # is listing.city is contain settings.city?
+        matrix = self.__city_mask(listings)
+        # is listing.rooms is equal to settings.rooms?
+        matrix &= self.__room_mask(self.__values(listings, "rooms"))
+        # is listing.price is between price min and price max?
+        price = self.__values(listings, "price")
+        matrix &= np.isnan(price) | (
+            (self.price_min < price) & (price < self.price_max)
+        )
+        # is listing.size is between size min and size max?
+        size = self.__values(listings, "size_m2")
+        matrix &= (
+            np.isnan(size)
+            | ~self.has_size
+            | ((self.size_min < size) & (size < self.size_max))
+        )
+        return matrix
+
+    def pairs(self, listings):
+        """Yield (listing, user id) for every match, chunk by chunk."""
+        for start in range(0, len(listings), self.chunk_size):
+            chunk = listings[start : start + self.chunk_size]
+            rows, cols = np.nonzero(self.match_matrix(chunk))
+            for row, col in zip(rows, cols):
+                yield chunk[row], self.user_ids[col]
@@ -2,6 +2,8 @@ from datetime import datetime
 import json
 from sqlalchemy.dialects.postgresql import UUID
 
+from models.matching import SettingsPredicate
+
 
 class CustomListing:
     id: str | UUID
@@ -24,6 +26,9 @@ class CustomListing:
         self.micro_location = kwargs.get("micro_location", "")
 
     def validate_settings(self, settings):
+        # compiled settings skip the json parsing
+        if isinstance(settings, SettingsPredicate):
+            return settings.matches(self)
         settings = json.loads(settings)
         price_min, price_max = settings["price"].split("-")
         size_min, size_max = settings["size"].split("-")
@@ -18,6 +18,7 @@ class Report(Base):
     total_actual_listings = Column(Integer, nullable=False, default=0)
     total_new_listings = Column(Integer, nullable=False, default=0)
     total_changed_listings = Column(Integer, nullable=False, default=0)
+    total_queued_listings = Column(Integer, nullable=False, default=0)
     item_scraped_count = Column(Integer, nullable=False, default=0)
     item_dropped_count = Column(Integer, nullable=False, default=0)
     response_error_count = Column(Integer, nullable=False, default=0)
@@ -1,8 +1,44 @@
 import re
+import hashlib
 from datetime import datetime as dt
 
+# descriptions are compared through their md5, as computed by postgres md5()
+DIGEST_FIELDS = ["short_description", "detail_description"]
+
+# fields compared to detect a listing change, in fingerprint order
+FINGERPRINT_FIELDS = [
+    "price",
+    "city",
+    "municipality",
+    "micro_location",
+    "short_description",
+    "detail_description",
+    "size_m2",
+    "rooms",
+]
+
+
+def text_digest(value):
+    if value is None:
+        return None
+    return hashlib.md5(value.encode()).hexdigest()
+
 
 class PreviousListing:
+    __slots__ = (
+        "raw_data_id",
+        "url",
+        "price",
+        "status",
+        "city",
+        "municipality",
+        "micro_location",
+        "short_description",
+        "detail_description",
+        "size_m2",
+        "rooms",
+    )
+
     def __init__(self, **kwargs):
         self.raw_data_id = kwargs.get("raw_data_id")
         self.url = kwargs.get("url")
@@ -26,3 +62,21 @@ class PreviousListing:
                     self.price = round(float(self.price), 2)
                 except (ValueError, TypeError):
                     self.price = -1
+
+    def fingerprint(self):
+        # sha256 over the normalized comparable fields, stored on the listing
+        values = []
+        for field in FINGERPRINT_FIELDS:
+            value = getattr(self, field)
+            if field == "price":
+                value = value if value else -1
+            if field in ("size_m2", "rooms") and isinstance(value, str):
+                # stored numeric, "3+" is written as 3
+                try:
+                    value = float(value.replace("+", ""))
+                except ValueError:
+                    pass
+            if isinstance(value, (int, float)):
+                value = repr(float(value))
+            values.append("" if value is None else str(value))
+        return hashlib.sha256("\x1f".join(values).encode()).hexdigest()
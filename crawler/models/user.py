@@ -2,7 +2,8 @@ from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, String, Text, DateTime, func
 import uuid
-import json
+
+from models.matching import settings_predicate
 
 Base = declarative_base()
 
@@ -19,10 +20,7 @@ class User(Base):
     profile_url = Column(String(255), nullable=False)
     settings = Column(Text, nullable=False, default="{}")
 
-    def settings_as_where_clause(self):
-        settings = json.loads(self.settings)
-        city = settings["city"]
-        price_min, price_max = settings["price"].split("-")
-        size_min, size_max = settings["size"].split("-")
-        rooms = settings["rooms"]
-        return f"city = '{city}' AND price >= {price_min} AND price <= {price_max} AND size_m2 >= {size_min} AND size_m2 <= {size_max} AND rooms = {rooms}"
+    def settings_as_where_clause(self, listing_alias="ll", property_alias="lp"):
+        # parameterized clause and its params, compiled once per settings
+        predicate = settings_predicate(self.id, self.settings)
+        return predicate.as_where_clause(listing_alias, property_alias)
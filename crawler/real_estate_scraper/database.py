@@ -1,10 +1,66 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, text
 from sqlalchemy.orm import sessionmaker
 from decouple import config
+import logging
+import traceback
+import time
 
-engine = create_engine(config("DB_URL"))
+from real_estate_scraper.templates.sql.error import error_insert_query
+
+logger = logging.getLogger(__name__)
+
+# One bounded pool shared by the pipelines, the spiders and the error writers
+engine = create_engine(
+    config("DB_URL"),
+    pool_size=config("DB_POOL_SIZE", default=5, cast=int),
+    max_overflow=config("DB_POOL_MAX_OVERFLOW", default=2, cast=int),
+    pool_timeout=config("DB_POOL_TIMEOUT", default=30, cast=int),
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Ping a pooled connection on checkout only when it was idle for this long
+POOL_PING_IDLE_SECONDS = config("DB_POOL_PING_IDLE", default=60, cast=int)
+
+pool_stats = dict(checkouts=0, pings=0, invalidated=0, max_checked_out=0)
+
+
+@event.listens_for(engine, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    connection_record.info["checked_in_at"] = time.monotonic()
+
+
+@event.listens_for(engine, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats["checkouts"] += 1
+    pool_stats["max_checked_out"] = max(
+        pool_stats["max_checked_out"], engine.pool.checkedout()
+    )
+    checked_in_at = connection_record.info.get("checked_in_at")
+    if checked_in_at is None:
+        return
+    if time.monotonic() - checked_in_at < POOL_PING_IDLE_SECONDS:
+        return
+    pool_stats["pings"] += 1
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        dbapi_connection.rollback()
+    except Exception:
+        pool_stats["invalidated"] += 1
+        # the pool discards the connection and checks out a fresh one
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def pool_metrics():
+    return dict(
+        size=engine.pool.size(),
+        checked_out=engine.pool.checkedout(),
+        overflow=engine.pool.overflow(),
+        **pool_stats,
+    )
+
 
 def get_db():
     db = SessionLocal()
@@ -12,3 +68,20 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def insert_error(url, error_type, err, error_traceback=None):
+    # errors are written in their own transaction so they survive a rollback
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                text(error_insert_query),
+                dict(
+                    url=url,
+                    error_type=error_type,
+                    error_message=str(err),
+                    error_traceback=error_traceback or traceback.format_exc(),
+                ),
+            )
+    except Exception as e:
+        logger.error("Error inserting error for %s: %s", url, e)
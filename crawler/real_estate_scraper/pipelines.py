@@ -5,51 +5,107 @@
 
 
 # useful for handling different item types with a single interface
+from scrapy import signals
 from scrapy.exceptions import DropItem
-from datetime import datetime as dt
-from decouple import config
-from models.listing_change import PreviousListing
-from real_estate_scraper.database import get_db
-from models.error import Report, Error
-from models.user import User
-from models.queue import Queue
+from datetime import datetime as dt, timedelta
+from models.matching import MatchingEngine
+from models.batch_matching import BatchMatcher
+from models.listing_change import PreviousListing, DIGEST_FIELDS, text_digest
+from real_estate_scraper.database import (
+    engine,
+    insert_error,
+    pool_metrics,
+    SessionLocal,
+)
+from models.error import Report
 from models.custom_listing import CustomListing
 from models import Agent, Seller
-from sqlalchemy import text
-import dj_database_url
+from sqlalchemy import event, text
+from psycopg2.extras import execute_values
+from contextlib import contextmanager
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 import psycopg2
+import hashlib
 import json
+import logging
 import traceback
 import jmespath
 import uuid
 import re
-from real_estate_scraper.templates.sql.listing import listing_insert_query
-from real_estate_scraper.templates.sql.error import error_insert_query
-from models.property import Property
+import time
+from real_estate_scraper.raw_store import open_store
+from real_estate_scraper.templates.sql.error import error_insert_pyformat_query
+from real_estate_scraper.templates.sql.listing import (
+    listing_insert_query,
+    listing_bulk_upsert_query,
+    listing_bulk_values_template,
+)
+from real_estate_scraper.templates.sql.queue import (
+    insert_queue_pairs,
+    new_listings_query,
+    newest_listing_query,
+    queue_insert_matches_query,
+    watermark_insert_query,
+    watermark_lock_query,
+    watermark_update_query,
+)
+
+
+ZERO_UUID = "00000000-0000-0000-0000-000000000000"
+
+logger = logging.getLogger(__name__)
+
+
+def as_number(value):
+    # "3+" and numeric strings as float, anything else as None
+    if isinstance(value, str):
+        value = value.replace("+", "")
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
 
 
 def keep_url_only(item):
     return dict(url=item.get("url", "URL not exists"))
 
 
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends to the server."""
+
+    def execute(self, query, vars=None):
+        self.counter.round_trips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.counter.round_trips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+
 class PostgreSQLConnection:
     def __init__(self):
-        self.conn = None
+        self.connection = None  # pooled SQLAlchemy connection
+        self.conn = None  # its psycopg2 connection
         self.cursor = None
+        self.round_trips = 0
+        self.reconnects = 0
         self.connect()
 
     def connect(self):
         try:
-            if not self.conn or self.conn.closed:
-                db_config = dj_database_url.parse(config("DB_URL"))
-                self.conn = psycopg2.connect(
-                    database=db_config["NAME"],
-                    user=db_config["USER"],
-                    password=db_config["PASSWORD"],
-                    host=db_config["HOST"],
-                    port=db_config["PORT"],
-                )
-                self.cursor = self.conn.cursor()
+            if self.connection is not None:
+                # drop the broken connection instead of returning it to the pool
+                self.reconnects += 1
+                self.connection.invalidate()
+                self.connection.close()
+            self.connection = engine.connect()
+            self.conn = self.connection.connection.dbapi_connection
+            self.cursor = self.conn.cursor(cursor_factory=CountingCursor)
+            self.cursor.counter = self
+            # the SQLAlchemy session runs on the same connection, count it too
+            event.listen(self.connection, "before_cursor_execute", self.__count)
+            event.listen(self.connection, "commit", self.__count)
         except Exception as err:
             raise ConnectionError(
                 "Could not establish connection with PostgreSQL database: {0}".format(
@@ -57,33 +113,113 @@ class PostgreSQLConnection:
                 )
             )
 
-    def ensure_connection(self):
-        try:
-            # Test if connection is alive
-            self.cursor.execute("SELECT 1")
-        except (psycopg2.InterfaceError, psycopg2.OperationalError):
-            # Reconnect if connection is closed
-            self.connect()
+    def __count(self, *args):
+        self.round_trips += 1
 
-    def execute(self, query, params=None):
+    def execute(self, query, params=None, idempotent=None):
+        # statements run optimistically, the connection is only replaced when
+        # the server is gone and a read-only statement is retried once
+        if idempotent is None:
+            idempotent = query.lstrip().upper().startswith("SELECT")
+        # the writes of an open transaction are lost with the connection
+        in_transaction = (
+            not self.conn.closed
+            and self.conn.info.transaction_status != TRANSACTION_STATUS_IDLE
+        )
         try:
-            self.ensure_connection()
             self.cursor.execute(query, params)
         except (psycopg2.InterfaceError, psycopg2.OperationalError):
-            # Try one more time
             self.connect()
+            if not idempotent or in_transaction:
+                raise
             self.cursor.execute(query, params)
 
     def commit(self):
-        self.ensure_connection()
+        self.round_trips += 1
         self.conn.commit()
 
     def rollback(self):
-        self.ensure_connection()
-        self.conn.rollback()
+        self.round_trips += 1
+        try:
+            self.conn.rollback()
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            # the transaction died with the connection
+            self.connect()
+
+
+class UnitOfWork:
+    """
+    Item scoped transaction shared by every pipeline stage.
+
+    The stages only execute their statements, the item is committed once by
+    CommitPipeline or rolled back when it is dropped. Inside a batch every item
+    gets its own savepoint and the whole batch is committed once. Work that
+    spans several items (batched writes) runs after the next commit, in its own
+    transaction.
+    """
+
+    def __init__(self, psql):
+        self.psql = psql
+        self.in_batch = False
+        self.in_savepoint = False
+        self.hooks = []
+
+    def after_commit(self, hook):
+        if hook not in self.hooks:
+            self.hooks.append(hook)
+
+    def __run_hooks(self):
+        hooks, self.hooks = self.hooks, []
+        for hook in hooks:
+            hook()
+            self.psql.commit()
+
+    def begin(self):
+        if self.in_batch:
+            self.psql.execute("SAVEPOINT item;")
+            self.in_savepoint = True
+
+    def commit(self):
+        if self.in_batch:
+            if self.in_savepoint:
+                self.in_savepoint = False
+                self.psql.execute("RELEASE SAVEPOINT item;")
+        else:
+            self.psql.commit()
+            self.__run_hooks()
+
+    def rollback(self):
+        if self.in_batch:
+            # the item of a failed begin() has no savepoint to roll back
+            if self.in_savepoint:
+                self.in_savepoint = False
+                self.psql.execute("ROLLBACK TO SAVEPOINT item;")
+                self.psql.execute("RELEASE SAVEPOINT item;")
+        else:
+            self.psql.rollback()
+
+    @contextmanager
+    def batch(self):
+        self.in_batch = True
+        try:
+            yield self
+        except Exception:
+            self.in_batch = False
+            self.in_savepoint = False
+            self.psql.rollback()
+            raise
+        self.in_batch = False
+        self.in_savepoint = False
+        self.psql.commit()
+        self.__run_hooks()
 
 
 class DatabaseConnection:
+    """
+    One pooled connection per crawler process, the psycopg2 cursor and the
+    SQLAlchemy session both run on it and share its transaction.
+    """
+
     _instance = None
     _db = None
 
@@ -91,7 +227,8 @@ class DatabaseConnection:
         if cls._instance is None:
             cls._instance = super(DatabaseConnection, cls).__new__(cls)
             cls._instance._psql = PostgreSQLConnection()
-            cls._instance._db = next(get_db())
+            cls._instance._db = SessionLocal(bind=cls._instance._psql.connection)
+            cls._instance._uow = UnitOfWork(cls._instance._psql)
         return cls._instance
 
     @property
@@ -100,14 +237,52 @@ class DatabaseConnection:
 
     @property
     def db(self):
+        # follow the psycopg2 side when it had to reconnect
+        if self._db.bind is not self._psql.connection:
+            self._db.close()
+            self._db.bind = self._psql.connection
         return self._db
 
+    @property
+    def uow(self):
+        return self._uow
+
 
 class BasePipeline:
     def __init__(self):
         self.conn = DatabaseConnection()
-        self.db = self.conn.db  # SQLAlchemy session
         self.psql = self.conn.psql  # PostgreSQL connection
+        self.uow = self.conn.uow  # item transaction
+
+    @property
+    def db(self):
+        return self.conn.db  # SQLAlchemy session
+
+    def insert_item_error(self, url, error_type, err):
+        """
+        Record the error of a failing item once its writes are rolled back.
+        A batch holds the listings_error rows it deleted until it commits, so
+        inside a batch the row is written by the batch transaction: on another
+        connection the insert would wait on them forever.
+        """
+        error_traceback = traceback.format_exc()
+        self.uow.rollback()
+        if not self.uow.in_batch:
+            insert_error(url, error_type, err, error_traceback)
+            return
+        params = dict(
+            url=url,
+            error_type=error_type,
+            error_message=str(err),
+            error_traceback=error_traceback,
+        )
+        self.psql.execute("SAVEPOINT error;")
+        try:
+            self.psql.execute(error_insert_pyformat_query, params)
+            self.psql.execute("RELEASE SAVEPOINT error;")
+        except Exception as e:
+            self.psql.execute("ROLLBACK TO SAVEPOINT error;")
+            logger.error("Error inserting error for %s: %s", url, e)
 
 
 class SourcesPipeline(BasePipeline):
@@ -116,7 +291,7 @@ class SourcesPipeline(BasePipeline):
         q = "SELECT id,base_url FROM listings_source WHERE base_url='{}';".format(
             item["source"]["base_url"]
         )
-        self.psql.cursor.execute(q)
+        self.psql.execute(q)
         existing_source = self.psql.cursor.fetchone()
         if existing_source:
             item["source"]["id"] = str(existing_source[0])
@@ -144,10 +319,8 @@ class SourcesPipeline(BasePipeline):
         """
         # execute query
         try:
-            self.psql.cursor.execute(q, source_item)
-            self.psql.conn.commit()
+            self.psql.execute(q, source_item)
         except Exception as err:
-            self.psql.conn.rollback()
             raise ValueError("Source insertion failed: {0}".format(err))
         return item
 
@@ -167,21 +340,20 @@ class SellersPipeline(BasePipeline):
             seller_type = "person"
         seller_name = jmespath.search("seller.name", item) or "Unknown Seller"
         source_seller_id = jmespath.search("seller.source_seller_id", item)
-        seller = (
-            self.db.query(Seller)
-            .filter(
-                Seller.source_seller_id == str(source_seller_id),
-                Seller.name == seller_name,
-                Seller.seller_type == seller_type,
-            )
-            .first()
-        )
+        q = """
+        SELECT id FROM listings_seller
+        WHERE source_seller_id=%s AND name=%s AND seller_type=%s
+        LIMIT 1;
+        """
+        self.psql.execute(q, (str(source_seller_id), seller_name, seller_type))
+        seller = self.psql.cursor.fetchone()
         # if seller exists, grab the seller id
         if seller:
-            item["seller"]["id"] = str(seller.id)
+            item["seller"]["id"] = str(seller[0])
         # if not, insert new seller
         else:
-            seller_item = Seller(
+            seller_item = dict(
+                id=str(uuid.uuid4()),
                 source_seller_id=source_seller_id,
                 name=seller_name,
                 seller_type=seller_type,
@@ -189,10 +361,19 @@ class SellersPipeline(BasePipeline):
                 primary_email=jmespath.search("seller.primary_email", item),
                 website=jmespath.search("seller.website", item),
             )
-            self.db.add(seller_item)
-            self.db.commit()
-            self.db.refresh(seller_item)
-            item["seller"]["id"] = str(seller_item.id)
+            q = """
+            INSERT INTO listings_seller (
+                id, created_at, updated_at,
+                source_seller_id, name, seller_type,
+                primary_phone, primary_email, website
+            ) VALUES (
+                %(id)s, now(), now(),
+                %(source_seller_id)s, %(name)s, %(seller_type)s,
+                %(primary_phone)s, %(primary_email)s, %(website)s
+            );
+            """
+            self.psql.execute(q, seller_item)
+            item["seller"]["id"] = seller_item["id"]
         # collect the seller id and registry number
         if registry_number:
             seller_id = jmespath.search("seller.id", item)
@@ -217,10 +398,29 @@ class SellersPipeline(BasePipeline):
 class ListingPipeline(BasePipeline):
     def __init__(self):
         super().__init__()
+        # buffered mode: (item, listing_item, deferred) waiting to be flushed
+        self.buffer = []
+        self.buffer_size = 0
+        self.buffer_timeout = 0
+        self.flush_call = None
+        self.queue_matcher = "index"
+        self.watermark_overlap = timedelta(0)
+        self.queue_chunk_size = 1000
+        self.matcher = MatchingEngine()
 
-    def __queue_new_listings(self, spider):
-        today = dt.now().strftime(r"%Y-%m-%d")
-        users = self.db.query(User).all()
+    def __lock_watermark(self, spider):
+        # first pass of a source starts from today, as before the watermark
+        today = dt.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.psql.execute(
+            watermark_insert_query,
+            dict(source_name=spider.name, created_at=today, listing_id=ZERO_UUID),
+        )
+        self.psql.execute(watermark_lock_query, dict(source_name=spider.name))
+        return self.psql.cursor.fetchone()
+
+    def __queue_matches(self, params):
+        self.psql.execute("SELECT id, settings FROM bot_user;")
+        users = self.psql.cursor.fetchall()
         # query new listings
         cols = [
             "id",
@@ -232,44 +432,49 @@ class ListingPipeline(BasePipeline):
             "size_m2",
             "rooms",
         ]
-        q = text(
-            f"""
-            SELECT
-                ll.id,
-                ll.url,
-                ll.city,
-                ll.price,
-                ll.municipality,
-                ll.micro_location,
-                lp.size_m2,
-                lp.rooms
-            FROM listings_listing as ll
-            JOIN listings_property as lp ON lp.listing_id = ll.id
-            WHERE ll.price > 0 AND lp.size_m2 > 0 AND ll.created_at >= '{today}'
-            AND ll.status = 'active' AND ll.url LIKE '%{spider.name}%'
-            ORDER BY ll.created_at DESC;
-            """
-        )
-        result = self.db.execute(q)
-        listings = result.fetchall()
+        self.psql.execute(new_listings_query, params)
+        listings = self.psql.cursor.fetchall()
         # convert raw data into custom listings
         listings = [dict(zip(cols, listing)) for listing in listings]
         listings = [CustomListing(**item) for item in listings]
-        # send all the listings via telegram bot as notifications
-        for user in users:
-            user_queues = (
-                self.db.query(Queue.listing_id).filter(Queue.user_id == user.id).all()
+        # compile the users settings, rebuilt only when they changed
+        self.matcher.sync(users)
+        pairs = ((l.id, user_id) for l, user_id in self.matcher.pairs(listings))
+        return insert_queue_pairs(self.psql.cursor, pairs, self.queue_chunk_size)
+
+    def __queue_new_listings(self, spider):
+        # match only the listings added since the last pass of the source
+        try:
+            created_at, listing_id = self.__lock_watermark(spider)
+            params = dict(
+                source=f"%{spider.name}%",
+                after_created_at=created_at - self.watermark_overlap,
+                after_id=listing_id,
             )
-            user_queues = [u[0] for u in user_queues]
-            for l in listings:
-                if l.id not in user_queues and l.validate_settings(user.settings):
-                    # create queue
-                    queue = Queue(listing_id=l.id, user_id=user.id)
-                    try:
-                        self.db.add(queue)
-                        self.db.commit()
-                    except Exception:
-                        self.db.rollback()
+            self.psql.execute(newest_listing_query, params)
+            newest = self.psql.cursor.fetchone()
+            if newest:
+                params.update(until_created_at=newest[0], until_id=newest[1])
+                if self.queue_matcher == "sql":
+                    # match and insert in the database, nothing crosses the wire
+                    self.psql.execute(queue_insert_matches_query, params)
+                    inserted = self.psql.cursor.rowcount
+                else:
+                    inserted = self.__queue_matches(params)
+                spider.total_queued_listings += inserted
+                self.psql.execute(
+                    watermark_update_query,
+                    dict(
+                        source_name=spider.name,
+                        created_at=newest[0],
+                        listing_id=newest[1],
+                    ),
+                )
+            self.psql.commit()
+        except Exception as err:
+            self.psql.rollback()
+            insert_error("", "Queue insertion", err)
+            spider.logger.error("Error on queue insertion: %s", err)
 
         # for listing in listings:
         #     # Query all users who already have this listing in their queue
@@ -292,15 +497,7 @@ class ListingPipeline(BasePipeline):
         #             except Exception as err:
         #                 self.db.rollback()
 
-    def process_item(self, item, spider):
-        # query the existing listing by url
-        q = text(f"SELECT * FROM listings_listing WHERE url='{item['url']}';")
-        existing_listing = self.db.execute(q).fetchone()
-        if not existing_listing:
-            spider.total_new_listings += 1
-        else:
-            item["listing_id"] = existing_listing[2]
-
+    def __listing_item(self, item):
         # construct listing data
         listing_item = dict(
             listing_id=item["listing_id"],
@@ -324,42 +521,182 @@ class ListingPipeline(BasePipeline):
             listing_item["price"] = -1
         elif isinstance(listing_price, str) and not re.search(r"\d+", listing_price):
             listing_item["price"] = -1
-        # insert value
+        return listing_item
+
+    def process_item(self, item, spider):
+        if self.buffer_size > 1:
+            return self.__buffer_item(item, spider)
+
+        listing_item = self.__listing_item(item)
+        # upsert value, the canonical id is returned for existing urls
         try:
-            self.db.execute(text(listing_insert_query), listing_item)
-            self.db.commit()
+            self.psql.execute(listing_insert_query, listing_item)
+            listing_id, inserted = self.psql.cursor.fetchone()
         except Exception as err:
-            self.db.rollback()
-            spider.total_new_listings -= 1
+            self.uow.rollback()
             if not listing_item.get("title"):
-                q = text(
-                    f"""
-                    UPDATE listings_listing SET status='removed', updated_at=now()
-                    WHERE url='{item["url"]}';
-                    """
-                )
-                self.db.execute(q)
-                self.db.commit()
+                q = """
+                UPDATE listings_listing SET status='removed', updated_at=now()
+                WHERE url=%s;
+                """
+                self.psql.execute(q, (item["url"],))
+                self.uow.commit()
                 raise DropItem("Listing insertion failed: {0}".format(err))
             # Insert error to db
-            db = next(get_db())
-            error = Error(
-                url=item["url"],
-                error_type="Listing insertion",
-                error_message=str(err),
-                error_traceback=traceback.format_exc(),
-            )
-            db.add(error)
-            db.commit()
-            db.close()
+            insert_error(item["url"], "Listing insertion", err)
             raise DropItem("Listing insertion failed: {0}".format(err))
 
+        if inserted:
+            spider.total_new_listings += 1
+        item["listing_id"] = str(listing_id)
+        item["is_new_listing"] = inserted
+
         # remove listing url from error if it exists
-        self.db.query(Error).filter(Error.url == item["url"]).delete()
-        self.db.commit()
+        self.psql.execute(
+            "DELETE FROM listings_error WHERE url=%s;", (item["url"],)
+        )
         return item
 
+    def __buffer_item(self, item, spider):
+        # hold the item until the buffer is flushed, the downstream pipelines
+        # continue once its deferred fires with the stored listing id
+        from twisted.internet import defer, reactor
+
+        # the source and seller rows are shared, keep them out of the batch
+        self.uow.commit()
+        d = defer.Deferred()
+        self.buffer.append((item, self.__listing_item(item), d))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush(spider)
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.buffer_timeout, self.flush, spider)
+        return d
+
+    def __upsert_listings(self, listing_items):
+        # write the whole batch as one multi-row upsert
+        self.psql.execute("SAVEPOINT listing_batch;")
+        try:
+            rows = execute_values(
+                self.psql.cursor,
+                listing_bulk_upsert_query,
+                listing_items,
+                template=listing_bulk_values_template,
+                page_size=len(listing_items),
+                fetch=True,
+            )
+            self.psql.execute("RELEASE SAVEPOINT listing_batch;")
+            return {url: (listing_id, inserted) for listing_id, url, inserted in rows}
+        except Exception:
+            self.psql.execute("ROLLBACK TO SAVEPOINT listing_batch;")
+        # the batch failed, isolate the failing rows one by one
+        results = {}
+        for listing_item in listing_items:
+            self.psql.execute("SAVEPOINT listing_row;")
+            try:
+                rows = execute_values(
+                    self.psql.cursor,
+                    listing_bulk_upsert_query,
+                    [listing_item],
+                    template=listing_bulk_values_template,
+                    fetch=True,
+                )
+                self.psql.execute("RELEASE SAVEPOINT listing_row;")
+                listing_id, _, inserted = rows[0]
+                results[listing_item["url"]] = (listing_id, inserted)
+            except Exception as err:
+                self.psql.execute("ROLLBACK TO SAVEPOINT listing_row;")
+                results[listing_item["url"]] = err
+        return results
+
+    def flush(self, spider):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        buffer, self.buffer = self.buffer, []
+        if not buffer:
+            return
+
+        urls = [listing_item["url"] for _, listing_item, _ in buffer]
+        try:
+            with self.uow.batch():
+                self.__flush_batch(spider, buffer, urls)
+        except Exception as err:
+            # Insert error to db
+            insert_error("", "Listing batch", err)
+            spider.logger.error("Error on listing batch: %s", err)
+        finally:
+            # an item must never be left waiting, its request would hang
+            for _, _, d in buffer:
+                if not d.called:
+                    d.errback(DropItem("Listing batch failed"))
+
+    def __flush_batch(self, spider, buffer, urls):
+        try:
+            results = self.__upsert_listings([l for _, l, _ in buffer])
+            # mark listings without title as removed
+            removed_urls = [
+                listing_item["url"]
+                for _, listing_item, _ in buffer
+                if isinstance(results[listing_item["url"]], Exception)
+                and not listing_item.get("title")
+            ]
+            if removed_urls:
+                self.psql.execute(
+                    """
+                    UPDATE listings_listing SET status='removed', updated_at=now()
+                    WHERE url = ANY(%s);
+                    """,
+                    (removed_urls,),
+                )
+            # remove listing urls from error if they exist
+            stored_urls = [u for u in urls if not isinstance(results[u], Exception)]
+            self.psql.execute(
+                "DELETE FROM listings_error WHERE url = ANY(%s);", (stored_urls,)
+            )
+        except Exception as err:
+            self.psql.rollback()
+            results = {url: err for url in urls}
+
+        # release the items in the order they were buffered, each one runs
+        # through the downstream pipelines inside its own savepoint
+        for item, listing_item, d in buffer:
+            result = results[listing_item["url"]]
+            if not isinstance(result, Exception):
+                try:
+                    self.uow.begin()
+                except Exception as err:
+                    # no savepoint, the item is dropped and the batch goes on
+                    result = err
+            if isinstance(result, Exception):
+                if listing_item.get("title"):
+                    # Insert error to db
+                    insert_error(
+                        item["url"],
+                        "Listing insertion",
+                        result,
+                        "".join(traceback.format_exception(result)),
+                    )
+                err = DropItem("Listing insertion failed: {0}".format(result))
+                d.errback(err)
+                continue
+            listing_id, inserted = result
+            if inserted:
+                spider.total_new_listings += 1
+            item["listing_id"] = str(listing_id)
+            item["is_new_listing"] = inserted
+            d.callback(item)
+
     def open_spider(self, spider):
+        # Buffered mode settings
+        self.buffer_size = spider.settings.getint("LISTING_BUFFER_SIZE", 0)
+        self.buffer_timeout = spider.settings.getfloat("LISTING_BUFFER_TIMEOUT", 5)
+        self.queue_matcher = spider.settings.get("QUEUE_MATCHER", "index")
+        self.watermark_overlap = timedelta(
+            seconds=spider.settings.getint("QUEUE_WATERMARK_OVERLAP", 60)
+        )
+        self.queue_chunk_size = spider.settings.getint("QUEUE_INSERT_CHUNK_SIZE", 1000)
+        if self.queue_matcher == "numpy":
+            self.matcher = BatchMatcher()
         # Load exisiting urls
         load_existings = spider.settings.get("LOAD_EXISTING_URLS")
         if load_existings and eval(load_existings):
@@ -381,6 +718,10 @@ class ListingPipeline(BasePipeline):
             raise ValueError("Error on spider close: {0}".format(err))
 
     def close_spider(self, spider):
+        # write the listings left in the buffer
+        self.flush(spider)
+        # queue new listings
+        self.__queue_new_listings(spider)
         # Access total_pages and total_listings from the spider
         total_pages = getattr(spider, "total_pages", 0)
         total_listings = getattr(spider, "total_listings", 0)
@@ -401,6 +742,7 @@ class ListingPipeline(BasePipeline):
             report.item_dropped_count = stats.get("item_dropped_count", 0)
             report.total_new_listings = spider.total_new_listings
             report.total_changed_listings = spider.total_changed_listings
+            report.total_queued_listings = spider.total_queued_listings
             report.response_error_count = stats.get("log_count/ERROR", 0)
             report.elapsed_time_seconds = elapsed_time.total_seconds()
             self.db.commit()
@@ -408,33 +750,95 @@ class ListingPipeline(BasePipeline):
             self.db.rollback()
             raise ValueError("Error on spider close: {0}".format(err))
 
-        # queue new listings
-        self.__queue_new_listings(spider)
-
 
 class RawDataPipeline(BasePipeline):
+    def __init__(self):
+        super().__init__()
+        self.store = None  # raw payload store, None keeps the text columns
+        self.samples = []  # payloads collected to train the source dictionary
+        self.dictionary_samples = 0
+
+    def open_spider(self, spider):
+        settings = spider.settings
+        self.store = open_store(
+            settings.get("RAW_PAYLOAD_BACKEND"),
+            psql=self.psql,
+            root=settings.get("RAW_PAYLOAD_DIR"),
+            level=settings.getint("RAW_PAYLOAD_LEVEL", 10),
+        )
+        if self.store and settings.getbool("RAW_PAYLOAD_DICTIONARY"):
+            # train a dictionary during this run when the source has none yet
+            if not self.store.load_dictionary(spider.name):
+                self.dictionary_samples = settings.getint(
+                    "RAW_PAYLOAD_DICTIONARY_SAMPLES", 500
+                )
+        self.psql.commit()
+
+    def close_spider(self, spider):
+        if not self.samples:
+            return
+        try:
+            self.store.train_dictionary(spider.name, self.samples)
+            self.psql.commit()
+        except Exception as err:
+            self.psql.rollback()
+            spider.logger.warning("Raw payload dictionary training failed: %s", err)
+
     def process_item(self, item, spider):
         # clean up HTML data related to halooglasi
         if "halooglasi" in item["url"]:
             item["raw_data"]["html"] = ""
         # COMMENT: figure out what 4zida criteria that would be allowed for raw data
         # construct raw data item
+        html = item["raw_data"]["html"] or ""
+        data = json.dumps(item["raw_data"]["data"])
         raw_data_item = dict(
             listing_id=item["listing_id"],
-            html=item["raw_data"]["html"],
-            data=json.dumps(item["raw_data"]["data"]),
+            html=html,
+            data=data,
+            content_hash=hashlib.sha256(f"{html}\0{data}".encode()).hexdigest(),
+            html_key=None,
+            data_key=None,
         )
-        # write the insert query
-        q = """
-        INSERT INTO listings_rawdata (id, created_at, updated_at, listing_id, html, data)
-        VALUES (uuid_generate_v4(), now(), now(), %(listing_id)s, %(html)s, %(data)s);
-        """
-        # execute the query
         try:
-            self.psql.cursor.execute(q, raw_data_item)
-            self.psql.conn.commit()
+            # skip the payload when it equals the listing's latest snapshot
+            q = """
+            SELECT rd.id, rd.content_hash
+            FROM listings_listing ll
+            JOIN listings_rawdata rd ON rd.id = ll.latest_raw_data_id
+            WHERE ll.id = %(listing_id)s;
+            """
+            self.psql.execute(q, raw_data_item)
+            latest_raw_data = self.psql.cursor.fetchone()
+            if latest_raw_data and latest_raw_data[1] == raw_data_item["content_hash"]:
+                item["raw_data_id"] = str(latest_raw_data[0])
+                return item
+            if self.store:
+                # keep the payloads compressed in the store
+                raw_data_item["html_key"] = self.store.put(html, spider.name)
+                raw_data_item["data_key"] = self.store.put(data, spider.name)
+                raw_data_item["html"] = ""
+                raw_data_item["data"] = ""
+                if len(self.samples) < self.dictionary_samples:
+                    self.samples.extend(p for p in (html, data) if p)
+            # write the insert query
+            q = """
+            INSERT INTO listings_rawdata (
+                id, created_at, updated_at, listing_id, html, data,
+                content_hash, html_key, data_key
+            ) VALUES (
+                uuid_generate_v4(), now(), now(), %(listing_id)s, %(html)s, %(data)s,
+                %(content_hash)s, %(html_key)s, %(data_key)s
+            ) RETURNING id;
+            """
+            # execute the query
+            self.psql.execute(q, raw_data_item)
+            item["raw_data_id"] = str(self.psql.cursor.fetchone()[0])
+            q = """
+            UPDATE listings_listing SET latest_raw_data_id = %s WHERE id = %s;
+            """
+            self.psql.execute(q, (item["raw_data_id"], item["listing_id"]))
         except Exception as err:
-            self.psql.conn.rollback()
             raise ValueError("Raw data insertion failed: {0}".format(err))
         return item
 
@@ -442,14 +846,14 @@ class RawDataPipeline(BasePipeline):
 class PropertyPipeline(BasePipeline):
     def process_item(self, item, spider):
         # Query existing property
-        existing_property = (
-            self.db.query(Property)
-            .filter(Property.listing_id == item["listing_id"])
-            .first()
+        self.psql.execute(
+            "SELECT id FROM listings_property WHERE listing_id=%s;",
+            (item["listing_id"],),
         )
+        existing_property = self.psql.cursor.fetchone()
 
         if existing_property:
-            item["property"]["id"] = str(existing_property.id)
+            item["property"]["id"] = str(existing_property[0])
             return item
 
         # construct property item
@@ -488,218 +892,480 @@ class PropertyPipeline(BasePipeline):
         """
         # execute the query
         try:
-            self.psql.cursor.execute(q, property_item)
-            self.psql.conn.commit()
+            self.psql.execute(q, property_item)
             item["property"]["id"] = str(property_item["id"])
         except Exception as err:
-            self.psql.rollback()
-            # Insert error to db
-            error = Error(
-                url=item["url"],
-                error_type="Property insertion",
-                error_message=str(err),
-                error_traceback=traceback.format_exc(),
-            )
-            self.db.add(error)
-            self.db.commit()
+            # Insert error to db, the item's writes are rolled back first
+            self.insert_item_error(item["url"], "Property insertion", err)
             raise DropItem("Error on property insertion: {0}".format(err))
         return item
 
 
 class ImagesPipeline(BasePipeline):
+    def __init__(self):
+        super().__init__()
+        self.images = {}  # listing id -> {image url: sequence number}
+
+    def open_spider(self, spider):
+        # load the images already stored for the source's listings
+        q = """
+        SELECT li.listing_id, li.url, li.sequence_number
+        FROM listings_image li
+        JOIN listings_listing ll ON ll.id = li.listing_id
+        WHERE ll.url LIKE %s;
+        """
+        self.psql.execute(q, (f"%{spider.name}%",))
+        for listing_id, url, sequence_number in self.psql.cursor:
+            self.images.setdefault(str(listing_id), {})[url] = sequence_number
+        self.psql.commit()
+
     def process_item(self, item, spider):
+        # only send the images the listing does not have yet
+        existing_images = self.images.pop(item["listing_id"], {})
         # construct image items
         image_items = []
+        moved_images = []
+        seen_urls = set()
         images = item["images"]
         for i, image_url in enumerate(images):
-            image_id = f"{item['listing_id']}_{i}"
-            # source_url = supabase_uploader(image_url, image_id)
-            image_items.append(
-                (
-                    item["listing_id"],
-                    image_url,
-                    image_url,
-                    i + 1,
+            if image_url in seen_urls:
+                continue
+            seen_urls.add(image_url)
+            sequence_number = existing_images.get(image_url)
+            if sequence_number is None:
+                image_items.append(
+                    (
+                        item["listing_id"],
+                        image_url,
+                        image_url,
+                        i + 1,
+                    )
                 )
-            )
-        # write the insert query
-        q = """
-        INSERT INTO listings_image (
-            id, created_at, updated_at,
-            listing_id,
-            source_url,
-            url,
-            sequence_number
-        ) VALUES (
-            uuid_generate_v4(), now(), now(), %s, %s, %s, %s
-        ) ON CONFLICT DO NOTHING;
-        """
-        # execute query
-        for image in image_items:
-            try:
-                self.psql.execute(q, image)
-                self.psql.commit()
-            except Exception as err:
-                self.psql.rollback()
-                raise ValueError("Image insertion failed: {0}".format(err))
+            elif sequence_number != i + 1:
+                moved_images.append((item["listing_id"], image_url, i + 1))
+        try:
+            if image_items:
+                # write the insert query, all new images go in one statement
+                q = """
+                INSERT INTO listings_image (
+                    id, created_at, updated_at,
+                    listing_id,
+                    source_url,
+                    url,
+                    sequence_number
+                ) VALUES %s ON CONFLICT DO NOTHING;
+                """
+                template = "(uuid_generate_v4(), now(), now(), %s, %s, %s, %s)"
+                execute_values(
+                    self.psql.cursor,
+                    q,
+                    image_items,
+                    template=template,
+                    page_size=len(image_items),
+                )
+            if moved_images:
+                # renumber the images that changed position
+                q = """
+                UPDATE listings_image AS li
+                SET sequence_number = v.sequence_number, updated_at = now()
+                FROM (VALUES %s) AS v (listing_id, url, sequence_number)
+                WHERE li.listing_id = v.listing_id AND li.url = v.url;
+                """
+                execute_values(
+                    self.psql.cursor,
+                    q,
+                    moved_images,
+                    template="(%s::uuid, %s, %s)",
+                    page_size=len(moved_images),
+                )
+        except Exception as err:
+            raise ValueError("Image insertion failed: {0}".format(err))
         return item
 
 
 class ListingChangePipeline(BasePipeline):
-    def process_item(self, item, spider):
-        # query existing listing
-        q = f"""
+    columns_to_check = [
+        "price",
+        "city",
+        "municipality",
+        "micro_location",
+        "short_description",
+        "detail_description",
+        "size_m2",
+        "rooms",
+    ]
+    listing_columns = [
+        "price",
+        "city",
+        "municipality",
+        "micro_location",
+        "short_description",
+        "detail_description",
+    ]
+    property_columns = ["size_m2", "rooms"]
+
+    def __init__(self):
+        super().__init__()
+        self.fingerprints = {}  # url -> stored comparable fingerprint
+        self.snapshots = {}  # url -> PreviousListing, listings without fingerprint
+        self.changes = []
+        self.listing_updates = {}  # listing id -> new listing values
+        self.property_updates = {}  # listing id -> new property values
+        self.fingerprint_updates = {}  # listing id -> new fingerprint
+        self.batch_size = 100
+        self.spider = None
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.batch_size = spider.settings.getint("LISTING_CHANGE_BATCH_SIZE", 100)
+        # only the fingerprints are kept, the fields are loaded on a mismatch
+        q = """
+        SELECT url, comparable_fingerprint
+        FROM listings_listing
+        WHERE url LIKE %s;
+        """
+        self.psql.execute(q, (f"%{spider.name}%",))
+        self.fingerprints = dict(self.psql.cursor.fetchall())
+        # listings stored before the fingerprints existed are diffed against a
+        # snapshot, their fingerprint is written on the first crawl
+        q = """
         SELECT
             ll.url,
             ll.price,
-            ll.status,
             ll.city,
             ll.municipality,
             ll.micro_location,
-            ll.detail_description,
-            ll.short_description,
+            md5(ll.short_description),
+            md5(ll.detail_description),
             lp.size_m2,
-            lp.rooms,
-            rd.id AS raw_data_id
+            lp.rooms
         FROM listings_listing ll
         JOIN listings_property lp ON lp.listing_id = ll.id
-        JOIN listings_rawdata rd ON rd.listing_id = ll.id
-        WHERE ll.id = '{item["listing_id"]}';
+        WHERE ll.url LIKE %s AND ll.comparable_fingerprint IS NULL;
         """
-        self.psql.cursor.execute(q)
-        columns = [
-            "url",
-            "price",
-            "status",
-            "city",
-            "municipality",
-            "micro_location",
-            "detail_description",
-            "short_description",
-            "size_m2",
-            "rooms",
-            "raw_data_id",
-        ]
-        listing = self.psql.cursor.fetchone()  # existing listing
-        if not listing:
-            spider.total_new_listings += 1
-        elif listing:
-            listing = dict(zip(columns, listing))
-            previous_listing = PreviousListing(**listing)
-            new_listing = PreviousListing(
-                price=item["price"],
-                status=item["status"],
-                city=item["address"]["city"],
-                municipality=item["address"]["municipality"],
-                micro_location=item["address"]["micro_location"],
-                short_description=item["short_description"],
-                detail_description=item["detail_description"],
-                size_m2=item["property"]["size_m2"],
-                rooms=item["property"]["rooms"],
+        self.psql.execute(q, (f"%{spider.name}%",))
+        columns = ["url"] + self.columns_to_check
+        self.snapshots = {
+            row[0]: PreviousListing(**dict(zip(columns, row)))
+            for row in self.psql.cursor
+        }
+        self.psql.commit()
+
+    def close_spider(self, spider):
+        self.flush()
+        self.psql.commit()
+
+    def __previous_listing(self, listing_id):
+        q = """
+        SELECT
+            ll.price,
+            ll.city,
+            ll.municipality,
+            ll.micro_location,
+            md5(ll.short_description),
+            md5(ll.detail_description),
+            lp.size_m2,
+            lp.rooms
+        FROM listings_listing ll
+        JOIN listings_property lp ON lp.listing_id = ll.id
+        WHERE ll.id = %s;
+        """
+        self.psql.execute(q, (listing_id,))
+        row = self.psql.cursor.fetchone()
+        if not row:
+            return None
+        return PreviousListing(**dict(zip(self.columns_to_check, row)))
+
+    def process_item(self, item, spider):
+        new_listing = PreviousListing(
+            url=item["url"],
+            price=item["price"],
+            status=item["status"],
+            city=item["address"]["city"],
+            municipality=item["address"]["municipality"],
+            micro_location=item["address"]["micro_location"],
+            short_description=item["short_description"],
+            detail_description=item["detail_description"],
+            size_m2=item["property"]["size_m2"],
+            rooms=item["property"]["rooms"],
+        )
+        # unchanged listing, one hash comparison
+        fingerprint = new_listing.fingerprint()
+        previous_fingerprint = self.fingerprints.get(item["url"])
+        if previous_fingerprint == fingerprint:
+            return item
+
+        listing_id = item["listing_id"]
+        self.fingerprints[item["url"]] = fingerprint
+        self.fingerprint_updates[listing_id] = (listing_id, fingerprint)
+        if len(self.fingerprint_updates) >= self.batch_size:
+            self.uow.after_commit(self.flush)
+
+        # new listing, or one without a stored fingerprint nor property yet
+        previous_listing = self.snapshots.pop(item["url"], None)
+        if previous_listing is None and previous_fingerprint is not None:
+            previous_listing = self.__previous_listing(listing_id)
+        if not previous_listing:
+            return item
+
+        # check the changes
+        changed_fields = []
+        for col in self.columns_to_check:
+            old_value = getattr(previous_listing, col)
+            new_value = getattr(new_listing, col)
+            if col in DIGEST_FIELDS:
+                # the old text is read from the listing row when flushing
+                if old_value == text_digest(new_value):
+                    continue
+                old_value = None
+            elif old_value == new_value:
+                continue
+            changed_fields.append(col)
+            self.changes.append(
+                (listing_id, f"{col}_change", col, old_value, new_value)
             )
-            # check the changes
-            columns_to_check = [
-                "price",
-                "city",
-                "municipality",
-                "micro_location",
-                "short_description",
-                "detail_description",
-                "size_m2",
-                "rooms",
-            ]
-            change_items = []
-            for col in columns_to_check:
-                old_value = getattr(previous_listing, col)
-                new_value = getattr(new_listing, col)
-                if old_value != new_value:
-                    change = dict(
-                        listing_id=item["listing_id"],
-                        raw_data_id=previous_listing.raw_data_id,
-                        change_type=f"{col}_change",
-                        field=col,
-                        old_value=old_value,
-                        new_value=new_value,
-                    )
-                    change_items.append(list(change.values()))
-            if len(change_items) > 0:
-                spider.total_changed_listings += 1
-                # execute query
+        if not changed_fields:
+            return item
+
+        spider.total_changed_listings += 1
+        if any(col in self.listing_columns for col in changed_fields):
+            price = new_listing.price if new_listing.price else -1
+            self.listing_updates[listing_id] = (listing_id, price) + tuple(
+                getattr(new_listing, col) for col in self.listing_columns[1:]
+            )
+        if any(col in self.property_columns for col in changed_fields):
+            self.property_updates[listing_id] = (listing_id,) + tuple(
+                getattr(new_listing, col) for col in self.property_columns
+            )
+        return item
+
+    def flush(self):
+        changes, self.changes = self.changes, []
+        listing_updates, self.listing_updates = self.listing_updates, {}
+        property_updates, self.property_updates = self.property_updates, {}
+        fingerprint_updates, self.fingerprint_updates = self.fingerprint_updates, {}
+        if not fingerprint_updates:
+            return
+        try:
+            # change rows first, the old descriptions still are in the listing
+            q = """
+            INSERT INTO listings_listingchange (
+                id, created_at, updated_at,
+                listing_id,
+                raw_data_id,
+                change_type,
+                field,
+                old_value,
+                new_value,
+                changed_at
+            )
+            SELECT
+                uuid_generate_v4(), now(), now(),
+                v.listing_id,
+                ll.latest_raw_data_id,
+                v.change_type,
+                v.field,
+                CASE v.field
+                    WHEN 'short_description' THEN ll.short_description
+                    WHEN 'detail_description' THEN ll.detail_description
+                    ELSE v.old_value
+                END,
+                v.new_value,
+                now()
+            FROM (VALUES %s) AS v (listing_id, change_type, field, old_value, new_value)
+            JOIN listings_listing ll ON ll.id = v.listing_id
+            ON CONFLICT DO NOTHING;
+            """
+            if changes:
+                execute_values(
+                    self.psql.cursor,
+                    q,
+                    changes,
+                    template="(%s::uuid, %s, %s, %s::text, %s::text)",
+                    page_size=len(changes),
+                )
+            ## UPDATE LISTINGS
+            if listing_updates:
                 q = """
-                INSERT INTO listings_listingchange (
-                    id, created_at, updated_at,
-                    listing_id,
-                    raw_data_id,
-                    change_type,
-                    field,
-                    old_value,
-                    new_value,
-                    changed_at
-                ) VALUES (
-                    uuid_generate_v4(), now(), now(), %s, %s, %s, %s, %s, %s, now()
-                ) ON CONFLICT DO NOTHING;
+                UPDATE listings_listing AS ll SET
+                    updated_at = now(),
+                    price = v.price,
+                    city = v.city,
+                    municipality = v.municipality,
+                    micro_location = v.micro_location,
+                    short_description = v.short_description,
+                    detail_description = v.detail_description
+                FROM (VALUES %s) AS v (
+                    id, price, city, municipality, micro_location,
+                    short_description, detail_description
+                )
+                WHERE ll.id = v.id;
                 """
-                # execute query
-                try:
-                    self.psql.cursor.executemany(q, change_items)
-                    self.psql.conn.commit()
-
-                    ## UPDATE LISTINGS
-                    # convert the new_value to SET clause
-                    new_values = {}
-                    for change in change_items:
-                        field = change[3]
-                        if field in [
-                            "price",
-                            "city",
-                            "municipality",
-                            "micro_location",
-                            "short_description",
-                            "detail_description",
-                        ]:
-                            new_values.update({field: change[5]})
-                    if "price" in new_values and not new_values["price"]:
-                        new_values["price"] = -1
-                    set_clause = ", ".join([f"{k} = %s" for k in new_values.keys()])
-                    # update the updated_at field on the listings table
-                    listing_id = item["listing_id"]
-                    q = f"""
-                    UPDATE listings_listing SET updated_at=now(), {set_clause}
-                    WHERE id='{listing_id}';
-                    """
-                    if set_clause != "":
-                        self.psql.cursor.execute(q, list(new_values.values()))
-                        self.psql.conn.commit()
-
-                    ## UPDATE PROPERTY
-                    new_values = {}
-                    for change in change_items:
-                        field = change[3]
-                        if field in ["size_m2", "rooms"]:
-                            new_values.update({field: change[5]})
-                    set_clause = ", ".join([f"{k} = %s" for k in new_values.keys()])
-                    # update the updated_at field on the listings table
-                    listing_id = item["listing_id"]
-                    q = f"""
-                    UPDATE listings_property SET updated_at=now(), {set_clause}
-                    WHERE listing_id='{listing_id}';
-                    """
-                    if set_clause != "":
-                        self.psql.cursor.execute(q, list(new_values.values()))
-                        self.psql.conn.commit()
-                except Exception as err:
-                    self.psql.conn.rollback()
-                    # Insert error to db
-                    db = next(get_db())
-                    error = Error(
-                        url=item["url"],
-                        error_type="Listing changes insertion",
-                        error_message=str(err),
-                        error_traceback=traceback.format_exc(),
-                    )
-                    db.add(error)
-                    db.commit()
-                    db.close()
-                    raise ValueError(
-                        "Error on listing changes insertion: {0}".format(err)
-                    )
+                execute_values(
+                    self.psql.cursor,
+                    q,
+                    list(listing_updates.values()),
+                    template="(%s::uuid, %s::numeric, %s, %s, %s, %s, %s)",
+                    page_size=len(listing_updates),
+                )
+            ## UPDATE PROPERTY
+            if property_updates:
+                q = """
+                UPDATE listings_property AS lp SET
+                    updated_at = now(),
+                    size_m2 = v.size_m2,
+                    rooms = v.rooms
+                FROM (VALUES %s) AS v (listing_id, size_m2, rooms)
+                WHERE lp.listing_id = v.listing_id;
+                """
+                execute_values(
+                    self.psql.cursor,
+                    q,
+                    list(property_updates.values()),
+                    template="(%s::uuid, %s::float8, %s::float8)",
+                    page_size=len(property_updates),
+                )
+            ## UPDATE FINGERPRINTS
+            q = """
+            UPDATE listings_listing AS ll SET
+                comparable_fingerprint = v.fingerprint
+            FROM (VALUES %s) AS v (id, fingerprint)
+            WHERE ll.id = v.id;
+            """
+            execute_values(
+                self.psql.cursor,
+                q,
+                list(fingerprint_updates.values()),
+                template="(%s::uuid, %s)",
+                page_size=len(fingerprint_updates),
+            )
+        except Exception as err:
+            self.psql.rollback()
+            # Insert error to db
+            insert_error("", "Listing changes insertion", err)
+            self.spider.logger.error("Error on listing changes insertion: %s", err)
+
+
+class NotificationPipeline(BasePipeline):
+    """
+    Streaming mode: match every new listing to the users settings as soon as
+    its property row exists, the queue rows are written in micro-batches once
+    the listings are committed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.streaming = False
+        self.matcher = MatchingEngine()
+        self.pending = []  # (listing id, user id) of uncommitted items
+        self.ready = []  # (listing id, user id) waiting to be queued
+        self.batch_size = 50
+        self.batch_timeout = 30
+        self.users_refresh = 300
+        self.users_synced_at = 0
+        self.flush_call = None
+        self.spider = None
+
+    def open_spider(self, spider):
+        settings = spider.settings
+        self.spider = spider
+        self.streaming = settings.getbool("NOTIFICATION_STREAMING", False)
+        self.batch_size = settings.getint("NOTIFICATION_BATCH_SIZE", 50)
+        self.batch_timeout = settings.getfloat("NOTIFICATION_BATCH_TIMEOUT", 30)
+        self.users_refresh = settings.getfloat("NOTIFICATION_USERS_REFRESH", 300)
+        if self.streaming:
+            self.__sync_users()
+            self.psql.commit()
+
+    def close_spider(self, spider):
+        if self.flush_call and self.flush_call.active():
+            self.flush_call.cancel()
+        self.ready.extend(self.pending)
+        self.pending = []
+        self.flush()
+        self.psql.commit()
+
+    def __sync_users(self):
+        # pick up the settings changed while crawling
+        self.psql.execute("SELECT id, settings FROM bot_user;")
+        self.matcher.sync(self.psql.cursor.fetchall())
+        self.users_synced_at = time.monotonic()
+
+    def process_item(self, item, spider):
+        if not self.streaming or not item.get("is_new_listing"):
+            return item
+        if item["status"] != "active":
+            return item
+        listing = CustomListing(
+            id=item["listing_id"],
+            city=item["address"]["city"],
+            price=as_number(item["price"]),
+            size_m2=as_number(item["property"]["size_m2"]),
+            rooms=as_number(item["property"]["rooms"]),
+        )
+        # same filter as the queue pass at spider close
+        if not (listing.price and listing.price > 0):
+            return item
+        if not (listing.size_m2 and listing.size_m2 > 0):
+            return item
+        if time.monotonic() - self.users_synced_at > self.users_refresh:
+            self.__sync_users()
+        for user_id in self.matcher.match(listing):
+            self.pending.append((listing.id, user_id))
+        self.uow.after_commit(self.__release)
+        return item
+
+    def __release(self):
+        # the pending listings are committed now
+        self.ready.extend(self.pending)
+        self.pending = []
+        if len(self.ready) >= self.batch_size:
+            self.flush()
+        elif self.ready and not (self.flush_call and self.flush_call.active()):
+            from twisted.internet import reactor
+
+            self.flush_call = reactor.callLater(self.batch_timeout, self.__timed_flush)
+
+    def __timed_flush(self):
+        self.flush()
+        self.psql.commit()
+
+    def flush(self):
+        ready, self.ready = self.ready, []
+        if not ready:
+            return
+        try:
+            inserted = insert_queue_pairs(self.psql.cursor, ready)
+            self.spider.total_queued_listings += inserted
+        except Exception as err:
+            self.psql.rollback()
+            # Insert error to db
+            insert_error("", "Queue insertion", err)
+            self.spider.logger.error("Error on queue insertion: %s", err)
+
+
+class CommitPipeline(BasePipeline):
+    """Commit the item transaction once every stage has written its rows."""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        crawler.signals.connect(pipeline.item_failed, signal=signals.item_dropped)
+        crawler.signals.connect(pipeline.item_failed, signal=signals.item_error)
+        return pipeline
+
+    def process_item(self, item, spider):
+        self.uow.commit()
+        return item
+
+    def item_failed(self, item, spider):
+        # a dropped item must not leave half-written rows behind
+        self.uow.rollback()
+
+    def close_spider(self, spider):
+        # expose the database usage in the crawl stats
+        stats = spider.crawler.stats
+        stats.set_value("db/round_trips", self.psql.round_trips)
+        stats.set_value("db/reconnects", self.psql.reconnects)
+        for key, value in pool_metrics().items():
+            stats.set_value(f"db/pool/{key}", value)
@@ -0,0 +1,223 @@
+"""
+Content addressed storage for the raw listing payloads (html and json).
+
+Payloads are zstd compressed and stored under the sha256 of their text, so a
+payload that was already seen is never written twice. A per-source trained
+dictionary can be used to compress the small, very similar pages better; the
+dictionary id is recorded in the zstd frame, so reading needs no extra column.
+"""
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+import hashlib
+import os
+import tempfile
+import zstandard
+
+DICTIONARY_SIZE = 112640  # 110 KB, the zstd default
+
+
+def payload_key(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RawPayloadStore(ABC):
+    def __init__(self, level=10):
+        self.level = level
+        self.compressors = {}  # dictionary id -> ZstdCompressor
+        self.decompressors = {}  # dictionary id -> ZstdDecompressor
+        self.dictionaries = {}  # source name -> ZstdCompressionDict
+
+    # backend specific storage
+    @abstractmethod
+    def _write(self, key, blob, size): ...
+
+    @abstractmethod
+    def _read(self, key): ...
+
+    @abstractmethod
+    def _write_dictionary(self, source_name, dict_id, blob): ...
+
+    @abstractmethod
+    def _read_dictionary(self, dict_id): ...
+
+    @abstractmethod
+    def _latest_dictionary(self, source_name): ...
+
+    def load_dictionary(self, source_name):
+        # use the latest trained dictionary of the source when there is one
+        blob = self._latest_dictionary(source_name)
+        if blob:
+            self.dictionaries[source_name] = zstandard.ZstdCompressionDict(blob)
+        return self.dictionaries.get(source_name)
+
+    def train_dictionary(self, source_name, samples):
+        samples = [sample.encode() for sample in samples if sample]
+        dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+        self._write_dictionary(
+            source_name, dictionary.dict_id(), dictionary.as_bytes()
+        )
+        self.dictionaries[source_name] = dictionary
+        return dictionary
+
+    def __compressor(self, source_name):
+        dictionary = self.dictionaries.get(source_name)
+        dict_id = dictionary.dict_id() if dictionary else 0
+        if dict_id not in self.compressors:
+            self.compressors[dict_id] = zstandard.ZstdCompressor(
+                level=self.level, dict_data=dictionary
+            )
+        return self.compressors[dict_id]
+
+    def __decompressor(self, dict_id):
+        if dict_id not in self.decompressors:
+            dictionary = None
+            if dict_id:
+                blob = self._read_dictionary(dict_id)
+                dictionary = zstandard.ZstdCompressionDict(blob)
+            self.decompressors[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=dictionary
+            )
+        return self.decompressors[dict_id]
+
+    def put(self, text, source_name=None):
+        """Store a payload and return its key, empty payloads are not stored."""
+        if not text:
+            return None
+        key = payload_key(text)
+        payload = text.encode()
+        blob = self.__compressor(source_name).compress(payload)
+        self._write(key, blob, len(payload))
+        return key
+
+    def get(self, key):
+        """Return the payload text stored under the key."""
+        if not key:
+            return ""
+        blob = self._read(key)
+        if blob is None:
+            raise KeyError("Raw payload not found: {0}".format(key))
+        dict_id = zstandard.get_frame_parameters(blob).dict_id
+        return self.__decompressor(dict_id).decompress(blob).decode()
+
+
+class PostgresPayloadStore(RawPayloadStore):
+    """Payloads stored as bytea in listings_rawpayload."""
+
+    def __init__(self, psql, level=10):
+        super().__init__(level)
+        self.psql = psql  # PostgreSQLConnection, its cursor changes on reconnect
+
+    @property
+    def cursor(self):
+        return self.psql.cursor
+
+    def _write(self, key, blob, size):
+        q = """
+        INSERT INTO listings_rawpayload (key, created_at, updated_at, data, size)
+        VALUES (%s, now(), now(), %s, %s)
+        ON CONFLICT (key) DO NOTHING;
+        """
+        self.psql.execute(q, (key, blob, size))
+
+    def _read(self, key):
+        q = "SELECT data FROM listings_rawpayload WHERE key=%s;"
+        self.psql.execute(q, (key,))
+        row = self.cursor.fetchone()
+        return bytes(row[0]) if row else None
+
+    def _write_dictionary(self, source_name, dict_id, blob):
+        q = """
+        INSERT INTO listings_rawpayloaddictionary (
+            id, created_at, updated_at, source_name, data
+        ) VALUES (%s, now(), now(), %s, %s)
+        ON CONFLICT (id) DO NOTHING;
+        """
+        self.psql.execute(q, (dict_id, source_name, blob))
+
+    def _read_dictionary(self, dict_id):
+        q = "SELECT data FROM listings_rawpayloaddictionary WHERE id=%s;"
+        self.psql.execute(q, (dict_id,))
+        return bytes(self.cursor.fetchone()[0])
+
+    def _latest_dictionary(self, source_name):
+        q = """
+        SELECT data FROM listings_rawpayloaddictionary
+        WHERE source_name=%s ORDER BY created_at DESC LIMIT 1;
+        """
+        self.psql.execute(q, (source_name,))
+        row = self.cursor.fetchone()
+        return bytes(row[0]) if row else None
+
+
+class FilesystemPayloadStore(RawPayloadStore):
+    """Payloads stored as <root>/<ab>/<cd>/<key>.zst files."""
+
+    def __init__(self, root, level=10):
+        super().__init__(level)
+        self.root = Path(root)
+
+    def __path(self, key):
+        return self.root / key[:2] / key[2:4] / f"{key}.zst"
+
+    def __write_file(self, path, blob):
+        # write to a temporary file first so readers never see partial files
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    def _write(self, key, blob, size):
+        path = self.__path(key)
+        if not path.exists():
+            self.__write_file(path, blob)
+
+    def _read(self, key):
+        path = self.__path(key)
+        return path.read_bytes() if path.exists() else None
+
+    def _write_dictionary(self, source_name, dict_id, blob):
+        directory = self.root / "dictionaries"
+        self.__write_file(directory / f"{dict_id}.dict", blob)
+        latest = directory / f"{source_name}.latest"
+        self.__write_file(latest, str(dict_id).encode())
+
+    def _read_dictionary(self, dict_id):
+        return (self.root / "dictionaries" / f"{dict_id}.dict").read_bytes()
+
+    def _latest_dictionary(self, source_name):
+        latest = self.root / "dictionaries" / f"{source_name}.latest"
+        if not latest.exists():
+            return None
+        return self._read_dictionary(int(latest.read_text()))
+
+
+def open_store(backend, psql=None, root=None, level=10):
+    if backend == "postgres":
+        return PostgresPayloadStore(psql, level)
+    if backend == "filesystem":
+        return FilesystemPayloadStore(root, level)
+    return None
+
+
+def load_raw_data(cursor, store, raw_data_id):
+    """
+    Read a listings_rawdata row with its payloads, whether they are kept in
+    the legacy text columns or in the payload store.
+    """
+    q = """
+    SELECT listing_id, html, data, html_key, data_key
+    FROM listings_rawdata WHERE id=%s;
+    """
+    cursor.execute(q, (raw_data_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    listing_id, html, data, html_key, data_key = row
+    return dict(
+        id=raw_data_id,
+        listing_id=listing_id,
+        html=store.get(html_key) if html_key else html,
+        data=store.get(data_key) if data_key else data,
+    )
@@ -69,6 +69,8 @@ ITEM_PIPELINES = {
     "real_estate_scraper.pipelines.PropertyPipeline": 500,
     "real_estate_scraper.pipelines.ImagesPipeline": 600,
     "real_estate_scraper.pipelines.ListingChangePipeline": 700,
+    "real_estate_scraper.pipelines.NotificationPipeline": 750,
+    "real_estate_scraper.pipelines.CommitPipeline": 800,
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -121,6 +123,44 @@ RETRY_HTTP_CODES = [500, 503, 504, 400, 403, 404, 408]
 # Custom settings
 LOAD_EXISTING_URLS = False
 
+# Buffer the listing upserts and write them as one multi-row upsert per flush
+# 0 = write every listing as soon as it is scraped
+LISTING_BUFFER_SIZE = 0
+# Flush a non-empty buffer after this many seconds
+LISTING_BUFFER_TIMEOUT = 5
+
+# Keep raw html/json payloads zstd compressed and content addressed
+# "postgres" (listings_rawpayload), "filesystem" (RAW_PAYLOAD_DIR) or None for
+# the plain listings_rawdata text columns
+RAW_PAYLOAD_BACKEND = None
+RAW_PAYLOAD_DIR = "raw_payloads"
+RAW_PAYLOAD_LEVEL = 10
+# Compress with a per-source trained dictionary, trained on the first
+# RAW_PAYLOAD_DICTIONARY_SAMPLES payloads of a run when the source has none
+RAW_PAYLOAD_DICTIONARY = False
+RAW_PAYLOAD_DICTIONARY_SAMPLES = 500
+
+# Write the listing change rows and listing/property updates in batches
+LISTING_CHANGE_BATCH_SIZE = 100
+
+# Matcher of the new listings to the users settings at spider close
+# "index" = compiled settings indexes, "numpy" = vectorized batch matching,
+# "sql" = one INSERT ... SELECT in the database
+QUEUE_MATCHER = "index"
+# Each pass matches the listings added after the source watermark, rescanning
+# this many seconds before it for listings committed late
+QUEUE_WATERMARK_OVERLAP = 60
+# Queue rows written per INSERT ... ON CONFLICT DO NOTHING statement
+QUEUE_INSERT_CHUNK_SIZE = 1000
+
+# Streaming notifications: queue each new listing for the matching users while
+# crawling, in micro-batches of this size or after this many seconds
+NOTIFICATION_STREAMING = False
+NOTIFICATION_BATCH_SIZE = 50
+NOTIFICATION_BATCH_TIMEOUT = 30
+# Reload the users settings while streaming after this many seconds
+NOTIFICATION_USERS_REFRESH = 300
+
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
@@ -4,14 +4,12 @@ import requests
 import re
 import uuid
 import jmespath
-import traceback
 
 from real_estate_scraper.func import clean_double_quotes
-from real_estate_scraper.database import get_db
+from real_estate_scraper.database import insert_error
 from real_estate_scraper.spiders.base import BaseSpider
 from real_estate_scraper.items import PropertyItem
 from scrapy.loader import ItemLoader
-from models.error import Error
 
 
 class A4zidaSpider(BaseSpider):
@@ -217,15 +215,7 @@ class A4zidaSpider(BaseSpider):
                 "images": images,
             }
         except Exception as e:
-            db = next(get_db())
-            error_data = Error(
-                url=response.url,
-                error_type="Spider",
-                error_message=str(e),
-                error_traceback=traceback.format_exc(),
-            )
-            db.add(error_data)
-            db.commit()
+            insert_error(response.url, "Spider", e)
 
     def find_property_data(self, response):
         script = response.css("script:contains('superIndividual')::Text").get()
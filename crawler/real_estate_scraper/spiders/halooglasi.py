@@ -4,14 +4,12 @@ import re
 import uuid
 import jmespath
 import json
-import traceback
 
 
 from real_estate_scraper.items import PropertyItem
-from real_estate_scraper.database import get_db
+from real_estate_scraper.database import insert_error
 from real_estate_scraper.decorators import json_finder
 from real_estate_scraper.spiders.base import BaseSpider
-from models.error import Error
 from scrapy.selector import Selector
 from scrapy.loader import ItemLoader
 
@@ -311,15 +309,7 @@ class HaloOglasiNekretnineSpider(BaseSpider):
                 # contains -> images table
             }
         except Exception as e:
-            db = next(get_db())
-            error_data = Error(
-                url=response.url,
-                error_type="Spider",
-                error_message=str(e),
-                error_traceback=traceback.format_exc(),
-            )
-            db.add(error_data)
-            db.commit()
+            insert_error(response.url, "Spider", e)
 
     @json_finder
     def find_property_data(self, response):
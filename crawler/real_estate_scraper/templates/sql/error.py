@@ -1,3 +1,5 @@
+import re
+
 error_insert_query = """
 INSERT INTO listings_error (
     id,
@@ -17,3 +19,6 @@ INSERT INTO listings_error (
     :error_traceback
 ) ON CONFLICT (url, error_type, error_message) DO UPDATE SET updated_at = now();
 """
+
+# the same statement for a psycopg2 cursor
+error_insert_pyformat_query = re.sub(r":(\w+)", r"%(\1)s", error_insert_query)
@@ -20,24 +20,76 @@ INSERT INTO listings_listing (
     latitude,
     longitude
 ) VALUES (
-    :listing_id,
-    now(),
-    now(),
-    now(),
-    now(),
-    :source_id,
-    :seller_id,
-    :url,
-    :title,
-    :short_description,
-    :detail_description,
-    :price,
-    :price_currency,
-    :status,
-    :city,
-    :municipality,
-    :micro_location,
-    :latitude,
-    :longitude
-) ON CONFLICT (url) DO UPDATE SET last_seen_at = now(), seller_id = :seller_id, source_id = :source_id;
+    %(listing_id)s,
+    now(),
+    now(),
+    now(),
+    now(),
+    %(source_id)s,
+    %(seller_id)s,
+    %(url)s,
+    %(title)s,
+    %(short_description)s,
+    %(detail_description)s,
+    %(price)s,
+    %(price_currency)s,
+    %(status)s,
+    %(city)s,
+    %(municipality)s,
+    %(micro_location)s,
+    %(latitude)s,
+    %(longitude)s
+) ON CONFLICT (url) DO UPDATE SET last_seen_at = now(), seller_id = %(seller_id)s, source_id = %(source_id)s
+RETURNING id, (xmax = 0) AS inserted;
 """
+
+listing_bulk_upsert_query = """
+INSERT INTO listings_listing (
+    id,
+    created_at,
+    updated_at,
+    first_seen_at,
+    last_seen_at,
+    source_id,
+    seller_id,
+    url,
+    title,
+    short_description,
+    detail_description,
+    price,
+    price_currency,
+    status,
+    city,
+    municipality,
+    micro_location,
+    latitude,
+    longitude
+) VALUES %s
+ON CONFLICT (url) DO UPDATE SET
+    last_seen_at = now(),
+    seller_id = EXCLUDED.seller_id,
+    source_id = EXCLUDED.source_id
+RETURNING id, url, (xmax = 0) AS inserted;
+"""
+
+listing_bulk_values_template = """(
+    %(listing_id)s,
+    now(),
+    now(),
+    now(),
+    now(),
+    %(source_id)s,
+    %(seller_id)s,
+    %(url)s,
+    %(title)s,
+    %(short_description)s,
+    %(detail_description)s,
+    %(price)s,
+    %(price_currency)s,
+    %(status)s,
+    %(city)s,
+    %(municipality)s,
+    %(micro_location)s,
+    %(latitude)s,
+    %(longitude)s
+)"""
@@ -0,0 +1,198 @@
+from itertools import islice
+
+# Settings of the enabled users, parsed from bot_user.settings_json the way
+# CustomListing.validate_settings does, users with invalid settings left out
+user_settings_cte = r"""
+user_settings AS MATERIALIZED (
+    SELECT
+        s.user_id,
+        -- '' is one empty token as ''.split(',') in python, it is in every city
+        coalesce(string_to_array(NULLIF(s.city, ''), ','), ARRAY['']) AS cities,
+        string_to_array(s.rooms, ',')::float8[] AS rooms,
+        split_part(s.price, '-', 1)::float8 AS price_min,
+        split_part(s.price, '-', 2)::float8 AS price_max,
+        CASE WHEN split_part(s.size, '-', 1) <> '' AND split_part(s.size, '-', 2) <> ''
+            THEN split_part(s.size, '-', 1)::float8 END AS size_min,
+        CASE WHEN split_part(s.size, '-', 1) <> '' AND split_part(s.size, '-', 2) <> ''
+            THEN split_part(s.size, '-', 2)::float8 END AS size_max
+    FROM (
+        SELECT
+            u.id AS user_id,
+            u.settings_json ->> 'city' AS city,
+            u.settings_json ->> 'rooms' AS rooms,
+            u.settings_json ->> 'price' AS price,
+            u.settings_json ->> 'size' AS size
+        FROM bot_user u
+        WHERE coalesce(u.settings_json -> 'is_enabled', 'true'::jsonb) NOT IN (
+            'false'::jsonb, 'null'::jsonb, '0'::jsonb, '""'::jsonb
+        )
+    ) s
+    WHERE s.city IS NOT NULL
+    AND s.rooms ~ '^\s*[0-9]*\.?[0-9]+\s*(,\s*[0-9]*\.?[0-9]+\s*)*$'
+    AND s.price ~ '^\s*[0-9]*\.?[0-9]+\s*-\s*[0-9]*\.?[0-9]+\s*$'
+    AND s.size ~ '^(\s*[0-9]*\.?[0-9]+\s*)?-(\s*[0-9]*\.?[0-9]+\s*)?$'
+)
+"""
+
+# Listings of a source added after the watermark (created_at, id), up to the
+# newest one seen when the pass started
+new_listings_condition = """
+ll.price > 0 AND lp.size_m2 > 0
+AND ll.status = 'active' AND ll.url LIKE %(source)s
+AND (ll.created_at, ll.id) > (%(after_created_at)s, %(after_id)s::uuid)
+AND (ll.created_at, ll.id) <= (%(until_created_at)s, %(until_id)s::uuid)
+"""
+
+new_listings_query = (
+    """
+SELECT
+    ll.id,
+    ll.url,
+    ll.city,
+    ll.price,
+    ll.municipality,
+    ll.micro_location,
+    lp.size_m2,
+    lp.rooms
+FROM listings_listing ll
+JOIN listings_property lp ON lp.listing_id = ll.id
+WHERE """
+    + new_listings_condition
+    + """
+ORDER BY ll.created_at, ll.id;
+"""
+)
+
+newest_listing_query = """
+SELECT ll.created_at, ll.id
+FROM listings_listing ll
+JOIN listings_property lp ON lp.listing_id = ll.id
+WHERE ll.price > 0 AND lp.size_m2 > 0
+AND ll.status = 'active' AND ll.url LIKE %(source)s
+AND (ll.created_at, ll.id) > (%(after_created_at)s, %(after_id)s::uuid)
+ORDER BY ll.created_at DESC, ll.id DESC
+LIMIT 1;
+"""
+
+watermark_insert_query = """
+INSERT INTO listings_queuewatermark (
+    source_name,
+    created_at,
+    updated_at,
+    last_created_at,
+    last_listing_id
+) VALUES (
+    %(source_name)s,
+    now(),
+    now(),
+    %(created_at)s,
+    %(listing_id)s
+) ON CONFLICT (source_name) DO NOTHING;
+"""
+
+# concurrent passes of a source wait here until the locking pass commits
+watermark_lock_query = """
+SELECT last_created_at, last_listing_id
+FROM listings_queuewatermark
+WHERE source_name = %(source_name)s
+FOR UPDATE;
+"""
+
+# never moves back, a pass may only rescan the overlap window
+watermark_update_query = """
+UPDATE listings_queuewatermark SET
+    updated_at = now(),
+    last_created_at = %(created_at)s,
+    last_listing_id = %(listing_id)s
+WHERE source_name = %(source_name)s
+AND (last_created_at, last_listing_id) < (%(created_at)s, %(listing_id)s::uuid);
+"""
+
+# Queue (listing id, user id) pairs, listings rolled back in the meantime are
+# skipped by the join
+queue_insert_pairs_query = """
+INSERT INTO listings_queue (
+    id,
+    created_at,
+    updated_at,
+    listing_id,
+    user_id,
+    is_sent
+)
+SELECT
+    uuid_generate_v4(),
+    now(),
+    now(),
+    v.listing_id,
+    v.user_id,
+    false
+FROM (VALUES %s) AS v (listing_id, user_id)
+JOIN listings_listing ll ON ll.id = v.listing_id
+ON CONFLICT (listing_id, user_id) DO NOTHING;
+"""
+
+
+def insert_queue_pairs(cursor, pairs, chunk_size=1000):
+    """
+    Queue (listing id, user id) pairs in chunks, pairs already queued are
+    skipped. Returns the number of rows actually inserted.
+    """
+    # imported here, the query templates stay importable without the driver
+    from psycopg2.extras import execute_values
+
+    inserted = 0
+    pairs = iter(pairs)
+    while chunk := list(islice(pairs, chunk_size)):
+        execute_values(
+            cursor,
+            queue_insert_pairs_query,
+            chunk,
+            template="(%s::uuid, %s::uuid)",
+            page_size=len(chunk),
+        )
+        inserted += cursor.rowcount
+    return inserted
+
+
+# Queue every new listing of a source for the users whose settings accept it:
+# strict price/size bounds, city token contained in the listing city
+queue_insert_matches_query = (
+    "WITH "
+    + user_settings_cte
+    + """
+INSERT INTO listings_queue (
+    id,
+    created_at,
+    updated_at,
+    listing_id,
+    user_id,
+    is_sent
+)
+SELECT
+    uuid_generate_v4(),
+    now(),
+    now(),
+    ll.id,
+    us.user_id,
+    false
+FROM listings_listing ll
+JOIN listings_property lp ON lp.listing_id = ll.id
+JOIN user_settings us ON (
+    coalesce(ll.city, '') = ''
+    OR EXISTS (
+        SELECT 1 FROM unnest(us.cities) AS c (city)
+        WHERE strpos(ll.city, c.city) > 0
+    )
+) AND (
+    coalesce(lp.rooms, 0) = 0 OR lp.rooms = ANY (us.rooms)
+) AND (
+    us.price_min < ll.price AND ll.price < us.price_max
+) AND (
+    us.size_min IS NULL OR (us.size_min < lp.size_m2 AND lp.size_m2 < us.size_max)
+)
+WHERE """
+    + new_listings_condition
+    + """
+ON CONFLICT (listing_id, user_id) DO NOTHING;
+"""
+)